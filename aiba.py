@@ -2,12 +2,18 @@ import logging
 
 import disnake
 from beanie import init_beanie
-from disnake.ext import commands
+from disnake.ext import commands, tasks
 from motor.motor_asyncio import AsyncIOMotorClient
 
+import api
+import util
+from metrics import SlowQueryListener
+from models.caches import WriteBehind
+from models.migrations import migrate
 from models.user import User
 from models.guild import Guild
-from models.request import Request
+from models.guild_member import GuildMember
+from models.request import Request, Txt2ImgRequest, ArtifyRequest, Img2ImgRequest
 
 # Logging Setup
 logger = logging.getLogger("disnake")
@@ -34,18 +40,46 @@ class Aiba(commands.Bot):
             command_sync_flags=command_sync_flags,
         )
 
-    # Test/Init commands/events
-    async def on_ready(self):
-        client = AsyncIOMotorClient("mongodb://localhost:27017")
+    async def start(self, *args, **kwargs):
+        # Connect to the database before logging in, so it's ready for anything
+        # that runs once the bot is (e.g. restoring the request queue).
+        listener = SlowQueryListener()
+        client = AsyncIOMotorClient(
+            "mongodb://localhost:27017", event_listeners=[listener]
+        )
+        await migrate(client["aiba"])
+        # Builds any indexes the models declare that don't exist yet
         await init_beanie(
             database=client["aiba"],
             document_models=[
                 User,
                 Guild,
+                GuildMember,
                 Request,
+                Txt2ImgRequest,
+                ArtifyRequest,
+                Img2ImgRequest,
             ],
         )
+        listener.attach(client["aiba"])
+        self.flush_writes.start()
+        await super().start(*args, **kwargs)
+
+    @tasks.loop(seconds=util.write_behind_interval)
+    async def flush_writes(self):
+        await WriteBehind.flush()
+
+    # Test/Init commands/events
+    async def on_ready(self):
         print(f"We have logged in as {self.user}")
 
+    async def close(self):
+        # Cancelling a flush partway would drop whatever it hadn't written yet, so
+        # let it finish; the final flush waits on it for the lock
+        self.flush_writes.stop()
+        await WriteBehind.flush()
+        await api.close_session()
+        await super().close()
+
 
 aiba = Aiba()
@@ -1,144 +1,446 @@
+import asyncio
+import contextlib
+import json
+import logging
+import math
 import os
-from datetime import datetime
+import random
+import time
+from datetime import datetime, timedelta
 from io import BytesIO
+from typing import List, Optional
+
 import PIL.Image
+import PIL.ImageOps
 import aiohttp
 import base64
 
 import disnake
-from PIL import PngImagePlugin
 
+import metrics
+from models.backend import Backend, BackendPool
 from models.guild import Guild
+from models.guild_member import GuildMember
+from models.predictor import RuntimePredictor
+from models.caches import InputCache, ResultCache, WriteBehind, link_or_copy
 from models.request import RequestType, Request, Img2ImgRequest, RequestStatus
-from models.user import User
+from models.request_queue import QueuedRequest
 from models.view import ScoreView
-from util import sanitized_file_name, base_url, outputs_dir, Interaction
+from util import (
+    sanitized_file_name,
+    outputs_dir,
+    lease_duration,
+    max_input_bytes,
+    download_timeout,
+    http_pool_limit,
+    http_pool_limit_per_host,
+    http_keepalive_timeout,
+    request_timeout,
+    request_timeout_factor,
+    unknown_cost_seconds,
+    connect_timeout,
+    batch_prompt_lists,
+)
+
+logger = logging.getLogger("disnake")
+
+# One long-lived session shared by every call to the WebUI, so connections are
+# pooled and kept alive between generations instead of being set up per request.
+_session: Optional[aiohttp.ClientSession] = None
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def get_session() -> aiohttp.ClientSession:
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=http_pool_limit,
+            limit_per_host=http_pool_limit_per_host,
+            keepalive_timeout=http_keepalive_timeout,
+        )
+        _session = aiohttp.ClientSession(
+            connector=connector,
+            headers={"Accept-Encoding": "gzip, deflate"},
+            auto_decompress=True,
+        )
+    return _session
+
+
+async def close_session():
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+async def ping(backend: Backend) -> bool:
+    session = get_session()
+    async with session.get(
+        f"{backend.url}/sdapi/v1/progress",
+        params={"skip_current_image": "true"},
+        timeout=aiohttp.ClientTimeout(total=5),
+    ) as response:
+        return response.status == 200
+
+
+async def interrupt(backend: Backend):
+    """Ask a backend to stop whatever it's generating, if it's listening at all."""
+    session = get_session()
+    try:
+        async with session.post(
+            f"{backend.url}/sdapi/v1/interrupt", timeout=aiohttp.ClientTimeout(total=5)
+        ):
+            pass
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        pass
+
+
+async def get_checkpoints() -> List[str]:
+    """Titles of the checkpoints the backends can load, as the WebUI lists them."""
+    session = get_session()
+    for backend in BackendPool.get_backends():
+        if not backend.healthy:
+            continue
+        try:
+            async with session.get(
+                f"{backend.url}/sdapi/v1/sd-models",
+                timeout=aiohttp.ClientTimeout(total=5),
+            ) as response:
+                if response.status == 200:
+                    return [model["title"] for model in await response.json()]
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            pass
+    return []
+
+
+async def load_checkpoint(backend: Backend, checkpoint: Optional[str]):
+    """
+    Make sure `backend` has `checkpoint` loaded before generating with it, so the
+    swap is timed on its own rather than counted as part of the generation.
+    """
+    if checkpoint is None:
+        return
+    session = get_session()
+    timeout = aiohttp.ClientTimeout(total=request_timeout, sock_connect=connect_timeout)
+    if backend.checkpoint is None:
+        async with session.get(
+            f"{backend.url}/sdapi/v1/options", timeout=timeout
+        ) as response:
+            if response.status == 200:
+                backend.checkpoint = (await response.json()).get("sd_model_checkpoint")
+    if backend.checkpoint == checkpoint:
+        return
+    start = time.monotonic()
+    async with session.post(
+        f"{backend.url}/sdapi/v1/options",
+        json={"sd_model_checkpoint": checkpoint},
+        timeout=timeout,
+    ) as response:
+        if response.status != 200:
+            # Leave it to override_settings in the payload to try again
+            logger.warning(
+                f"Couldn't load {checkpoint} on {backend.url} (Status: {response.status})"
+            )
+            backend.checkpoint = None
+            return
+    metrics.increment("checkpoint_swaps")
+    metrics.observe("checkpoint_swap", time.monotonic() - start)
+    backend.checkpoint = checkpoint
+
+
+class BackendError(Exception):
+    """A call to the WebUI couldn't get through or took too long."""
+
+    def __init__(self, timed_out: bool):
+        super().__init__("Timed out" if timed_out else "Couldn't be reached")
+        self.timed_out = timed_out
+
+
+@contextlib.contextmanager
+def webui_call():
+    """
+    Tell failed calls to the WebUI apart from anything else going wrong, since
+    posting to Discord goes through aiohttp too.
+    """
+    try:
+        yield
+    except asyncio.TimeoutError as e:
+        raise BackendError(timed_out=True) from e
+    except aiohttp.ClientError as e:
+        raise BackendError(timed_out=False) from e
+
+
+def deadline(backend: Backend, batch: List[QueuedRequest]) -> aiohttp.ClientTimeout:
+    """How long a generation call may take, going by how long the batch should."""
+    expected = 0.0
+    for qr in batch:
+        predicted = RuntimePredictor.predict(
+            req_type=qr.entry.req_type, cost=qr.entry.cost, backend=backend.url
+        )
+        expected += (
+            predicted if predicted is not None else qr.entry.cost * unknown_cost_seconds
+        )
+    return aiohttp.ClientTimeout(
+        total=request_timeout + request_timeout_factor * expected,
+        sock_connect=connect_timeout,
+    )
+
+
+def lease(request: Request, backend: Backend, cost: float):
+    request.status = RequestStatus.in_progress
+    request.backend = backend.url
+    request.cost = cost
+    request.attempts += 1
+    request.lease_expires = datetime.utcnow() + timedelta(seconds=lease_duration)
 
 
 async def generate(
-    inter: Interaction,
-    request: Request,
-    guild: Guild,
-    requestor: User,
-    original_author: User = None,
+    backend: Backend,
+    batch: List[QueuedRequest],
+    channels: List[disnake.abc.Messageable],
 ):
-    if request.req_type == RequestType.img2img:
-        await img2img(
-            inter=inter,
-            request=request,
-            guild=guild,
-            requestor=requestor,
-        )
+    if batch[0].request.req_type == RequestType.img2img:
+        await img2img(backend=backend, qr=batch[0], channel=channels[0])
+    else:
+        await txt2img(backend=backend, batch=batch, channels=channels)
+
+
+async def read_json(response: aiohttp.ClientResponse):
+    # Responses carry whole images, parsing them on the event loop holds up the gateway
+    body = await response.read()
+    return await asyncio.get_running_loop().run_in_executor(None, json.loads, body)
+
+
+def write_output(image: str, output_path: str):
+    """Write a base64 image from the WebUI to disk, as is if it's already a PNG."""
+    data = base64.b64decode(image)
+    if data.startswith(PNG_SIGNATURE):
+        with open(output_path, "wb") as f:
+            f.write(data)
     else:
-        await txt2img(
-            inter=inter,
-            request=request,
-            guild=guild,
-            requestor=requestor,
-            original_author=original_author,
+        PIL.Image.open(BytesIO(data)).save(output_path, "PNG")
+
+
+async def finish(
+    qr: QueuedRequest, channel: disnake.abc.Messageable, image: str, runtime: float
+):
+    request = qr.request
+    request.status = RequestStatus.finished
+    request.runtime = runtime
+    # Batched images share one runtime between them, which would skew predictions
+    if request.batch_size == 1:
+        RuntimePredictor.observe(
+            backend=request.backend,
+            req_type=request.req_type.value,
+            cost=qr.entry.cost,
+            runtime=runtime,
         )
+    GuildMember.log(
+        guild_id=request.source_guild_id,
+        user_id=request.requestor_id,
+        gpu_seconds=runtime / request.batch_size,
+    )
+    request.output_filename = sanitized_file_name(request.prompt, request.request_id)
+    output_path = os.path.join(outputs_dir, request.output_filename)
+    await asyncio.get_running_loop().run_in_executor(
+        None, write_output, image, output_path
+    )
+    if key := qr.entry.cache_key:
+        ResultCache.store(key=key, output_path=output_path)
+    await send_output(qr=qr, channel=channel)
+
+
+async def reuse(qr: QueuedRequest, channel: disnake.abc.Messageable, path: str):
+    """Finish a request with an image an identical request already produced."""
+    request = qr.request
+    request.status = RequestStatus.finished
+    request.runtime = 0.0
+    request.cached = True
+    request.output_filename = sanitized_file_name(request.prompt, request.request_id)
+    link_or_copy(path, os.path.join(outputs_dir, request.output_filename))
+    await send_output(qr=qr, channel=channel)
+
+
+async def send_output(qr: QueuedRequest, channel: disnake.abc.Messageable):
+    request = qr.request
+    embed = await request.get_output_embed()
+    # The request is about to be visible (and votable), so make sure it's written
+    WriteBehind.stage_changes(request)
+    await WriteBehind.flush()
+    message = await channel.send(
+        embed=embed, view=ScoreView(request_id=request.request_id)
+    )
+    request.output_message_url = message.jump_url
+    WriteBehind.stage_changes(request)
+
+
+async def fail(
+    qr: QueuedRequest,
+    channel: disnake.abc.Messageable,
+    status: int = None,
+    reason: str = None,
+):
+    qr.request.status = RequestStatus.error
+    WriteBehind.stage_changes(qr.request)
+    await WriteBehind.flush()
+    await channel.send(
+        reason or f"Bad response received from Stable Diffusion API (Status: {status})"
+    )
 
 
 async def txt2img(
-    inter: disnake.ApplicationCommandInteraction,
-    request: Request,
-    guild: Guild,
-    requestor: User,
-    original_author: User = None,
+    backend: Backend,
+    batch: List[QueuedRequest],
+    channels: List[disnake.abc.Messageable],
 ):
-    payload = guild.request_to_payload(req=request)
-    request.status = RequestStatus.in_progress
-    await request.save_changes()
-    async with aiohttp.ClientSession() as session:
-        start = datetime.now()
+    # Everything in a batch shares the same settings, only the seeds (and with
+    # prompt lists, the prompts) differ from one image to the next
+    requests = [qr.request for qr in batch]
+    payload = batch[0].guild.request_to_payload(req=requests[0])
+    if len(batch) > 1:
+        if batch_prompt_lists:
+            prompts = [request.prompt for request in requests]
+            payload["prompt"] = prompts if len(set(prompts)) > 1 else prompts[0]
+            payload["seed"] = [
+                request.seed if request.seed is not None else -1 for request in requests
+            ]
+        else:
+            # Image i of the call gets seed + i, so pick the seed here to know
+            # which one each request ended up with
+            seed = random.randrange(2**32 - len(batch))
+            payload["seed"] = seed
+            for i, request in enumerate(requests):
+                request.seed = seed + i
+        payload["batch_size"] = len(batch)
+    for qr in batch:
+        lease(request=qr.request, backend=backend, cost=qr.entry.cost)
+        qr.request.batch_size = len(batch)
+        WriteBehind.stage_changes(qr.request)
+    with webui_call():
+        await load_checkpoint(
+            backend=backend, checkpoint=batch[0].guild.settings.checkpoint
+        )
+        session = get_session()
+        start = time.monotonic()
         async with session.post(
-            f"{base_url}/sdapi/v1/txt2img", json=payload
+            f"{backend.url}/sdapi/v1/txt2img",
+            json=payload,
+            timeout=deadline(backend=backend, batch=batch),
         ) as response:
-            delta = datetime.now() - start
-            if response.status == 200:
-                request.status = RequestStatus.finished
-                request.runtime = float(f"{delta.seconds}.{delta.microseconds//10000}")
-                r = await response.json()
-                request.output_filename = sanitized_file_name(
-                    request.prompt, request.requestor_id
-                )
-                bio = BytesIO(base64.b64decode(r["images"][0]))
-                PIL.Image.open(bio).save(
-                    os.path.join(outputs_dir, request.output_filename)
-                )
-                embed = await request.get_output_embed()
-                await request.save_changes()
-                await inter.channel.send(
-                    embed=embed, view=ScoreView(request_id=request.request_id)
-                )
-            else:
-                request.status = RequestStatus.error
-                await request.save_changes()
-                await inter.channel.send(
-                    f"Bad response received from Stable Diffusion API (Status: {response.status})"
+            runtime = round(time.monotonic() - start, 2)
+            status = response.status
+            r = await read_json(response) if status == 200 else None
+    if r is None:
+        for qr, channel in zip(batch, channels):
+            await fail(qr=qr, channel=channel, status=status)
+        return
+    # If the WebUI sends back a grid as well, it comes first
+    images = r["images"][-len(batch) :]
+    for qr, channel, image in zip(batch, channels, images):
+        await finish(qr=qr, channel=channel, image=image, runtime=runtime)
+    for qr, channel in zip(batch[len(images) :], channels[len(images) :]):
+        await fail(qr=qr, channel=channel, status=status)
+
+
+class InputImageError(Exception):
+    pass
+
+
+async def fetch_image(url: str) -> bytes:
+    session = get_session()
+    timeout = aiohttp.ClientTimeout(
+        total=download_timeout, sock_connect=connect_timeout
+    )
+    try:
+        async with session.get(url, timeout=timeout) as response:
+            if response.status != 200:
+                raise InputImageError(
+                    f"Couldn't download the image (Status: {response.status})"
                 )
-    if guild.settings.delete_prompts:
-        await inter.delete_original_response()
+            if (response.content_length or 0) > max_input_bytes:
+                raise InputImageError("That image is too large to use.")
+            data = bytearray()
+            async for chunk in response.content.iter_chunked(64 * 1024):
+                data += chunk
+                if len(data) > max_input_bytes:
+                    raise InputImageError("That image is too large to use.")
+            return bytes(data)
+    except asyncio.TimeoutError:
+        raise InputImageError("Downloading the image took too long.")
+    except aiohttp.ClientError:
+        raise InputImageError("Couldn't download the image.")
 
 
-async def get_img_bytes(request: Img2ImgRequest):
-    async with aiohttp.ClientSession() as session:
-        async with session.post(request.original_img_url) as response:
-            BIO = BytesIO(await response.content.read())
-            img = PIL.Image.open(BIO)
+def prepare_init_image(data: bytes, width: int, height: int) -> str:
+    """
+    Shrink an Img2Img input to just cover the size it'll be generated at, and
+    encode it for the WebUI. Images that are small enough already are sent as is.
+    """
+    try:
+        img = PIL.Image.open(BytesIO(data))
+        scale = max(width / img.width, height / img.height)
+        if scale < 1:
+            size = (math.ceil(img.width * scale), math.ceil(img.height * scale))
+            # Lets JPEGs decode at a fraction of their size to begin with
+            img.draft("RGB", size)
+            img = PIL.ImageOps.exif_transpose(img)
+            if img.mode not in ("RGB", "RGBA"):
+                img = img.convert("RGBA")
+            scale = max(width / img.width, height / img.height)
+            size = (math.ceil(img.width * scale), math.ceil(img.height * scale))
             with BytesIO() as output_bytes:
-                use_metadata = False
-                metadata = PngImagePlugin.PngInfo()
-                for key, value in img.info.items():
-                    if isinstance(key, str) and isinstance(value, str):
-                        metadata.add_text(key, value)
-                        use_metadata = True
-                img.save(
-                    output_bytes, "PNG", pnginfo=(metadata if use_metadata else None)
-                )
-                return output_bytes.getvalue()
+                img.resize(size, PIL.Image.LANCZOS).save(output_bytes, "PNG")
+                data = output_bytes.getvalue()
+    except PIL.UnidentifiedImageError:
+        raise InputImageError("That doesn't look like an image.")
+    except PIL.Image.DecompressionBombError:
+        raise InputImageError("That image is too large to use.")
+    except OSError:
+        # Truncated or otherwise corrupt files only fail once they're decoded
+        raise InputImageError("That image couldn't be read.")
+    return base64.b64encode(data).decode("ascii")
+
+
+async def get_init_image(request: Img2ImgRequest, guild: Guild) -> str:
+    width, height = guild.settings.width, guild.settings.height
+    url = request.original_img_url
+    if (init_image := InputCache.get(url, width, height)) is None:
+        data = await fetch_image(url)
+        init_image = await asyncio.get_running_loop().run_in_executor(
+            None, prepare_init_image, data, width, height
+        )
+        InputCache.put(url, width, height, init_image)
+    return init_image
 
 
 async def img2img(
-    inter: disnake.ModalInteraction,
-    request: Img2ImgRequest,
-    guild: Guild,
-    requestor: User,
+    backend: Backend,
+    qr: QueuedRequest,
+    channel: disnake.abc.Messageable,
 ):
-    request.status = RequestStatus.in_progress
-    await request.save_changes()
-    img_data = await get_img_bytes(request=request)
-    img_data = str(base64.b64encode(img_data))
-    payload = guild.request_to_payload(req=request, data=img_data)
-    async with aiohttp.ClientSession() as session:
-        start = datetime.now()
+    request: Img2ImgRequest = qr.request
+    lease(request=request, backend=backend, cost=qr.entry.cost)
+    WriteBehind.stage_changes(request)
+    try:
+        init_image = await get_init_image(request=request, guild=qr.guild)
+    except InputImageError as e:
+        await fail(qr=qr, channel=channel, reason=str(e))
+        return
+    payload = qr.guild.request_to_payload(req=request, data=init_image)
+    with webui_call():
+        await load_checkpoint(backend=backend, checkpoint=qr.guild.settings.checkpoint)
+        session = get_session()
+        start = time.monotonic()
         async with session.post(
-            f"{base_url}/sdapi/v1/img2img", json=payload
+            f"{backend.url}/sdapi/v1/img2img",
+            json=payload,
+            timeout=deadline(backend=backend, batch=[qr]),
         ) as response:
-            delta = datetime.now() - start
-            if response.status == 200:
-                request.status = RequestStatus.finished
-                request.runtime = float(
-                    f"{delta.seconds}.{delta.microseconds // 10000}"
-                )
-                r = await response.json()
-                request.output_filename = sanitized_file_name(
-                    request.prompt, request.requestor_id
-                )
-                bio = BytesIO(base64.b64decode(r["images"][0]))
-                PIL.Image.open(bio).save(
-                    os.path.join(outputs_dir, request.output_filename)
-                )
-                embed = await request.get_output_embed()
-                await request.save_changes()
-                await inter.channel.send(
-                    embed=embed, view=ScoreView(request_id=request.request_id)
-                )
-            else:
-                request.status = RequestStatus.error
-                await request.save_changes()
-                await inter.channel.send(
-                    f"Bad response received from Stable Diffusion API (Status: {response.status})"
-                )
-    if guild.settings.delete_prompts:
-        await inter.delete_original_response()
+            runtime = round(time.monotonic() - start, 2)
+            status = response.status
+            r = await read_json(response) if status == 200 else None
+    if r is None:
+        await fail(qr=qr, channel=channel, status=status)
+        return
+    await finish(qr=qr, channel=channel, image=r["images"][0], runtime=runtime)
@@ -1,7 +1,8 @@
 import disnake
 from disnake.ext import commands
 
-from models.guild import Guild
+from api import get_checkpoints
+from models.guild import Guild, SamplerIndices, SamplerPresets
 from models.modal import NegativePromptAppendModal, NegativePromptOverwriteModal
 
 
@@ -35,7 +36,7 @@ class Config(commands.Cog):
     ):
         guild = await Guild.find_or_create(disnake_guild=inter.guild)
         guild.settings.visible_prompts = new_visible_prompts
-        await guild.save_changes()
+        await guild.save_settings()
         response = "visible" if new_visible_prompts else "invisible"
         await inter.response.send_message(
             f"{inter.author.mention} has set prompt messages to be {response} in this server by default."
@@ -50,7 +51,7 @@ class Config(commands.Cog):
         guild = await Guild.find_or_create(disnake_guild=inter.guild)
         guild.settings.delete_prompts_prompts = new_delete_prompts
         response = "to be deleted" if new_delete_prompts else "to not be deleted"
-        await guild.save_changes()
+        await guild.save_settings()
         await inter.response.send_message(
             f"{inter.author.mention} has set prompt messages {response} in this server by default."
         )
@@ -65,7 +66,7 @@ class Config(commands.Cog):
     ):
         guild = await Guild.find_or_create(disnake_guild=inter.guild)
         guild.settings.cfg_scale = new_cfg_scale
-        await guild.save_changes()
+        await guild.save_settings()
         await inter.response.send_message(
             f"{inter.author.mention} has updated this server's default CFG Scale to {new_cfg_scale}."
         )
@@ -80,11 +81,58 @@ class Config(commands.Cog):
     ):
         guild = await Guild.find_or_create(disnake_guild=inter.guild)
         guild.settings.steps = new_sample_steps
-        await guild.save_changes()
+        await guild.save_settings()
         await inter.response.send_message(
             f"{inter.author.mention} has updated this server's default number of sample steps to {new_sample_steps}."
         )
 
+    @update.sub_command(
+        name="sampler", description="Update this server's default sampler"
+    )
+    async def update_sampler(
+        self,
+        inter: disnake.ApplicationCommandInteraction,
+        new_sampler: str = commands.Param(
+            choices=[sampler.value for sampler in SamplerIndices]
+        ),
+    ):
+        guild = await Guild.find_or_create(disnake_guild=inter.guild)
+        guild.settings.sampler_index = SamplerIndices(new_sampler)
+        await guild.save_settings()
+        await inter.response.send_message(
+            f"{inter.author.mention} has updated this server's default sampler to {new_sampler}."
+        )
+
+    @update.sub_command(
+        name="preset",
+        description="Update this server's sampler, sample steps and CFG scale to a preset",
+    )
+    async def update_preset(
+        self,
+        inter: disnake.ApplicationCommandInteraction,
+        new_preset: str = commands.Param(
+            choices={
+                f"{p.title} ({p.sampler.value}, {p.steps} steps, CFG {p.cfg_scale})": p.name
+                for p in SamplerPresets
+            }
+        ),
+    ):
+        """
+        Update this server's sampler, sample steps and CFG scale to a preset.
+
+        Parameters
+        ----------
+        new_preset: Faster presets take fewer steps at some cost to quality. LCM needs an LCM checkpoint or LoRA.
+        """
+        preset = SamplerPresets[new_preset]
+        guild = await Guild.find_or_create(disnake_guild=inter.guild)
+        guild.settings.apply_preset(preset)
+        await guild.save_settings()
+        await inter.response.send_message(
+            f"{inter.author.mention} has updated this server to the {preset.title} preset: "
+            f"{preset.sampler.value} with {preset.steps} sample steps and a CFG Scale of {preset.cfg_scale}."
+        )
+
     @update.sub_command(
         name="resolution",
         description="Update this server's default generation resolution. Height = Width",
@@ -103,7 +151,7 @@ class Config(commands.Cog):
             guild = await Guild.find_or_create(disnake_guild=inter.guild)
             guild.settings.width = new_width
             guild.settings.height = new_width
-            await guild.save_changes()
+            await guild.save_settings()
             await inter.response.send_message(
                 f"{inter.author.mention} has updated this server's default resolution to {new_width}x{new_width}."
             )
@@ -119,7 +167,7 @@ class Config(commands.Cog):
     ):
         guild = await Guild.find_or_create(disnake_guild=inter.guild)
         guild.settings.denoising_strength = new_denoising_strength
-        await guild.save_changes()
+        await guild.save_settings()
         await inter.response.send_message(
             f"{inter.author.mention} has updated this server's default denoising strength to {new_denoising_strength}."
         )
@@ -148,6 +196,69 @@ class Config(commands.Cog):
                 modal=NegativePromptAppendModal(inter_id=str(inter.id), guild=guild)
             )
 
+    @update.sub_command(
+        name="queue_weight",
+        description="Update this server's share of the generation queue.",
+    )
+    async def update_queue_weight(
+        self,
+        inter: disnake.ApplicationCommandInteraction,
+        new_queue_weight: commands.Range[0.1, 10.0],
+    ):
+        # Server admins shouldn't be able to jump their own server up the queue
+        if inter.author.id != 189101288083030017:
+            await inter.response.send_message(
+                "Only the bot owner can change a server's queue weight.",
+                ephemeral=True,
+            )
+            return
+        guild = await Guild.find_or_create(disnake_guild=inter.guild)
+        guild.settings.queue_weight = new_queue_weight
+        await guild.save_settings()
+        await inter.response.send_message(
+            f"{inter.author.mention} has updated this server's queue weight to {new_queue_weight}."
+        )
+
+    @update.sub_command(
+        name="checkpoint",
+        description="Update which Stable Diffusion checkpoint this server generates with.",
+    )
+    async def update_checkpoint(
+        self, inter: disnake.ApplicationCommandInteraction, new_checkpoint: str
+    ):
+        """
+        Update which Stable Diffusion checkpoint this server generates with.
+
+        Parameters
+        ----------
+        new_checkpoint: The checkpoint to use, or "default" for whichever the backend has loaded
+        """
+        checkpoint = None if new_checkpoint == "default" else new_checkpoint
+        # If no backend can be reached to ask, take the admin's word for it
+        if (
+            checkpoint is not None
+            and checkpoint not in (checkpoints := await get_checkpoints())
+            and checkpoints
+        ):
+            await inter.response.send_message(
+                f"{new_checkpoint} isn't a checkpoint the backends have available.",
+                ephemeral=True,
+            )
+            return
+        guild = await Guild.find_or_create(disnake_guild=inter.guild)
+        guild.settings.checkpoint = checkpoint
+        await guild.save_settings()
+        await inter.response.send_message(
+            f"{inter.author.mention} has updated this server's checkpoint to {checkpoint or 'the default'}."
+        )
+
+    @update_checkpoint.autocomplete("new_checkpoint")
+    async def checkpoint_autocomplete(
+        self, inter: disnake.ApplicationCommandInteraction, string: str
+    ):
+        matches = [c for c in await get_checkpoints() if string.lower() in c.lower()]
+        return ["default"] + matches[:24]
+
     @update.sub_command(
         name="cfg_override",
         description="Update whether users can manually specify CFG scale.",
@@ -161,7 +272,7 @@ class Config(commands.Cog):
             message = "updated this server's settings so that the default CFG scale may now be overridden."
         else:
             message = "updated this server's settings so that the default CFG scale may not be overridden."
-        await guild.save_changes()
+        await guild.save_settings()
         await inter.response.send_message(f"{inter.author.mention} has {message}")
 
     @update.sub_command(
@@ -173,7 +284,7 @@ class Config(commands.Cog):
     ):
         guild = await Guild.find_or_create(disnake_guild=inter.guild)
         guild.settings.steps_override = new_steps_override
-        await guild.save_changes()
+        await guild.save_settings()
         if new_steps_override:
             message = "updated this server's settings so that the default Sample Steps may now be overridden."
         else:
@@ -1,29 +1,62 @@
 import asyncio
+import logging
 from zoneinfo import ZoneInfo
 
+import aiohttp
 import disnake
 from disnake.ext import commands, tasks
 
+import metrics
 import util
-from api import generate
+from api import BackendError, fail, generate, interrupt, ping, reuse
+from models.backend import Backend, BackendPool
+from models.caches import ResultCache, WriteBehind
 from models.guild import Guild
 from models.modal import Img2ImgModal
 from models.request import (
+    Request,
     Txt2ImgRequest,
     ArtifyRequest,
     Img2ImgRequest,
     RequestStatus,
 )
-from models.request_queue import RequestQueue
+from models.request_queue import RequestQueue, QueuedRequest, QueueEntry
 
 from models.user import User
 
+logger = logging.getLogger("disnake")
+
 
 class Generate(commands.Cog):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
-        self.lock = asyncio.Lock()
+        self.workers = set()
         self.dequeue.start()
+        self.health_check.start()
+        self.recover.start()
+        self.reap.start()
+
+    @staticmethod
+    async def acknowledge(inter: disnake.ApplicationCommandInteraction) -> Guild:
+        """
+        Defer the response before anything else touches the database, so a slow
+        database can't run a command past Discord's 3 second window. The prompt
+        embed is filled in once the request is queued.
+        """
+        loading = asyncio.ensure_future(Guild.find_or_create(disnake_guild=inter.guild))
+        try:
+            guild = await asyncio.wait_for(
+                asyncio.shield(loading), timeout=util.ack_budget
+            )
+            ephemeral = not guild.settings.visible_prompts
+        except asyncio.TimeoutError:
+            ephemeral = True
+        await inter.response.defer(ephemeral=ephemeral)
+        metrics.observe(
+            "interaction_ack",
+            (disnake.utils.utcnow() - inter.created_at).total_seconds(),
+        )
+        return await loading
 
     @commands.slash_command(
         name="generate",
@@ -36,6 +69,7 @@ class Generate(commands.Cog):
         prompt: str,
         cfg_scale: commands.Range[1, 30.0] = None,
         sample_steps: commands.Range[1, 150] = None,
+        seed: commands.Range[0, 4294967295] = None,
     ):
         """
         Generate an AIArt image according to the given prompt
@@ -45,8 +79,9 @@ class Generate(commands.Cog):
         prompt - string: The prompt to send to the AI
         cfg_scale - Optional, float, 1-30: "Classifier-Free Guidance", how much the AI sticks to the prompt. Low = Higher quality, far from prompt. High = Lower quality, close to prompt
         sample_steps - Optional, int, 1-150: The number of iterations the AI uses to process the image. Higher = More time to process, higher quality.
+        seed - Optional, int: Fix the seed, so the same prompt and settings give the same image again.
         """
-        guild = await Guild.find_or_create(disnake_guild=inter.guild)
+        guild = await self.acknowledge(inter)
         requestor = await User.find_or_create(disnake_user=inter.author)
         request = Txt2ImgRequest(
             requestor_id=requestor.discord_id,
@@ -56,22 +91,26 @@ class Generate(commands.Cog):
             prompt=prompt,
             cfg_scale=cfg_scale,
             sample_steps=sample_steps,
+            seed=seed,
         )
         request = guild.validate_request(req=request)
-        await request.save()
-        await requestor.log_request(
-            request_id=request.request_id, prompt=request.prompt
-        )
+        WriteBehind.stage_insert(request)
+        await requestor.log_request()
         await guild.log_request(discord_id=requestor.discord_id)
-        await RequestQueue.add(
-            req=request, guild=guild, inter=inter, requestor=requestor
-        )
+        if path := await RequestQueue.add(req=request, guild=guild, inter=inter):
+            await self.answer_cached(
+                inter=inter,
+                request=request,
+                requestor=requestor,
+                guild=guild,
+                path=path,
+            )
+            return
         embed = await request.get_prompt_embed(
             queue_pos=await RequestQueue.resolve_queue_pos(req_id=request.request_id),
+            eta=await RequestQueue.resolve_eta(req_id=request.request_id),
         )
-        await inter.response.send_message(
-            embed=embed, ephemeral=not guild.settings.visible_prompts
-        )
+        await inter.edit_original_response(embed=embed)
 
     @commands.message_command(
         name="Artify",
@@ -79,7 +118,7 @@ class Generate(commands.Cog):
         dm_permission=False,
     )
     async def artify(self, inter: disnake.MessageCommandInteraction):
-        guild = await Guild.find_or_create(disnake_guild=inter.guild)
+        guild = await self.acknowledge(inter)
         requestor = await User.find_or_create(disnake_user=inter.author)
         original_author = await User.find_or_create(disnake_user=inter.target.author)
         request = ArtifyRequest(
@@ -91,24 +130,24 @@ class Generate(commands.Cog):
             prompt=inter.target.content,
         )
         request = guild.validate_request(req=request)
-        await request.save()
-        await requestor.log_request(
-            request_id=request.request_id, prompt=request.prompt
-        )
+        WriteBehind.stage_insert(request)
+        await requestor.log_request()
         await guild.log_request(discord_id=requestor.discord_id)
-        await RequestQueue.add(
-            req=request,
-            inter=inter,
-            guild=guild,
-            requestor=requestor,
-            original_author=original_author,
-        )
+        if path := await RequestQueue.add(req=request, guild=guild, inter=inter):
+            await self.answer_cached(
+                inter=inter,
+                request=request,
+                requestor=requestor,
+                guild=guild,
+                path=path,
+                original_author=original_author,
+            )
+            return
         embed = await request.get_prompt_embed(
             queue_pos=await RequestQueue.resolve_queue_pos(req_id=request.request_id),
+            eta=await RequestQueue.resolve_eta(req_id=request.request_id),
         )
-        await inter.response.send_message(
-            embed=embed, ephemeral=not guild.settings.visible_prompts
-        )
+        await inter.edit_original_response(embed=embed)
 
     @commands.message_command(
         name="Img2Img",
@@ -124,7 +163,7 @@ class Generate(commands.Cog):
             source_channel_id=inter.channel_id,
             date=inter.created_at.replace(tzinfo=ZoneInfo("UTC")),
         )
-        await request.save()
+        WriteBehind.stage_insert(request)
         await guild.log_request(discord_id=requestor.discord_id)
         message = inter.target
         image_url = None
@@ -140,26 +179,222 @@ class Generate(commands.Cog):
         if not image_url:
             await inter.response.send_message("No image found in target message!")
             request.status = RequestStatus.error
-            await request.save_changes()
+            WriteBehind.stage_changes(request)
         else:
             await request.set_original_img(url=image_url)
             await inter.response.send_modal(
                 Img2ImgModal(request=request, guild=guild, requestor=requestor)
             )
 
-    @tasks.loop(seconds=5.0)
+    @commands.slash_command(
+        name="cancel",
+        description="Cancel your most recent request that is still waiting in the queue.",
+        dm_permission=False,
+    )
+    async def cancel(self, inter: disnake.ApplicationCommandInteraction):
+        entry = await RequestQueue.get_latest(requestor_id=str(inter.author.id))
+        if not entry or not await RequestQueue.remove(req_id=entry.request_id):
+            await inter.response.send_message(
+                "You don't have any requests waiting in the queue.", ephemeral=True
+            )
+            return
+        # Only the id is kept while it's queued, and it may not have been written yet
+        await WriteBehind.flush()
+        request = await Request.get_by_id(mongo_id=entry.request_id)
+        request.status = RequestStatus.cancelled
+        WriteBehind.stage_changes(request)
+        await inter.response.send_message(
+            f"Cancelled your request for `{request.original_prompt}`.",
+            ephemeral=True,
+        )
+        source_guild = await Guild.find_or_create(discord_id=entry.guild_id)
+        if entry.token is not None and source_guild.settings.delete_prompts:
+            await self.delete_prompt(token=entry.token)
+
+    @tasks.loop()
     async def dequeue(self):
-        if not util.paused:
-            async with self.lock:
-                if qr := await RequestQueue.dequeue():
-                    await generate(
-                        inter=qr.inter,
-                        request=qr.request,
-                        guild=qr.guild,
-                        requestor=qr.requestor,
-                        original_author=qr.original_author,
+        # Sleeps until a request is queued and a backend slot is free, so nothing
+        # runs while the queue is idle. Each request (or batch of compatible
+        # requests) gets its own worker so every backend can have up to its limit
+        # in flight at once.
+        await RequestQueue.wait()
+        # Go to a backend that already has the next checkpoint loaded if one is
+        # free, and let whichever backend we get pick work for its own checkpoint
+        backend = await BackendPool.acquire(prefer=RequestQueue.peek_checkpoint())
+        if entry := await RequestQueue.dequeue(backend=backend):
+            worker = asyncio.create_task(self.work(backend=backend, head=entry))
+            self.workers.add(worker)
+            worker.add_done_callback(self.workers.discard)
+        else:
+            BackendPool.release(backend)
+
+    async def answer_cached(
+        self,
+        inter: disnake.ApplicationCommandInteraction,
+        request: Request,
+        requestor: User,
+        guild: Guild,
+        path: str,
+        original_author: User = None,
+    ):
+        """Finish a request an identical earlier one already made the image for."""
+        qr = QueuedRequest(
+            entry=QueueEntry(request=request, guild=guild, token=inter.token),
+            request=request,
+            requestor=requestor,
+            original_author=original_author,
+            guild=guild,
+        )
+        await reuse(qr=qr, channel=await self.get_channel(qr), path=path)
+        await inter.edit_original_response(
+            embed=await request.get_prompt_embed(queue_pos="Done", eta="Now")
+        )
+        await self.clean_up(qr)
+
+    async def get_channel(self, qr: QueuedRequest) -> disnake.abc.Messageable:
+        channel_id = qr.entry.channel_id
+        return self.bot.get_channel(channel_id) or await self.bot.fetch_channel(
+            channel_id
+        )
+
+    async def delete_prompt(self, token: str):
+        try:
+            await self.bot.http.delete_original_interaction_response(
+                self.bot.application_id, token
+            )
+        except disnake.HTTPException:
+            # Interaction tokens expire after 15 minutes, leave the prompt be
+            pass
+
+    async def clean_up(self, qr: QueuedRequest):
+        if qr.entry.token is not None and qr.guild.settings.delete_prompts:
+            await self.delete_prompt(token=qr.entry.token)
+
+    async def work(self, backend: Backend, head: QueueEntry):
+        entries, loaded, claimed, misses, channels = [head], [], [], [], []
+        following = set()
+        try:
+            # Waiting for a batch to fill happens here rather than in dequeue, so
+            # other free backends aren't held up by it
+            entries = await RequestQueue.fill_batch(head=head)
+            loaded = await RequestQueue.load(entries)
+            for qr in loaded:
+                channel = await self.get_channel(qr)
+                key = qr.entry.cache_key
+                if key and (path := ResultCache.lookup(key)):
+                    await reuse(qr=qr, channel=channel, path=path)
+                    await self.clean_up(qr)
+                elif key and (inflight := ResultCache.get_inflight(key)):
+                    # Someone is already generating this exact image, wait for theirs
+                    # without holding on to the backend. The future is taken now, as
+                    # the key is gone from inflight as soon as theirs is done
+                    follower = asyncio.create_task(
+                        self.follow(inflight=inflight, qr=qr, channel=channel)
                     )
+                    following.add(qr.entry.request_id)
+                    self.workers.add(follower)
+                    follower.add_done_callback(self.workers.discard)
+                else:
+                    if key:
+                        ResultCache.claim(key)
+                        claimed.append(key)
+                    misses.append(qr)
+                    channels.append(channel)
+            if misses:
+                await generate(backend=backend, batch=misses, channels=channels)
+                BackendPool.record_success(backend)
+                for qr in misses:
+                    await self.clean_up(qr)
+        except BackendError as e:
+            # A timeout may just be one slow request, but anything else means the
+            # backend can't be reached at all, so it's taken out of rotation
+            BackendPool.record_failure(backend, trip=not e.timed_out)
+            # The WebUI can only interrupt everything it's running, so it's left to
+            # finish if other jobs share it (this one still holds its own slot)
+            if e.timed_out and (backend.limit == 1 or backend.in_flight <= 1):
+                await interrupt(backend)
+            for qr, channel in zip(reversed(misses), reversed(channels)):
+                # Anything that got as far as being posted is done with
+                if qr.request.status == RequestStatus.in_progress:
+                    await self.retry(qr=qr, channel=channel)
+        except Exception:
+            # Not the backend's fault, so it isn't tripped and nothing is retried
+            logger.exception(f"Couldn't finish requests on {backend.url}")
+            for qr in loaded:
+                if qr.entry.request_id not in following and qr.request.status not in (
+                    RequestStatus.finished,
+                    RequestStatus.error,
+                ):
+                    await self.give_up(qr)
+        finally:
+            for key in claimed:
+                ResultCache.abandon(key)
+            for entry in entries:
+                if entry.request_id not in following:
+                    RequestQueue.release(entry.request_id)
+            BackendPool.release(backend)
+
+    async def give_up(self, qr: QueuedRequest):
+        """Fail a request something unexpected went wrong with, saying so if we can."""
+        try:
+            await fail(
+                qr=qr,
+                channel=await self.get_channel(qr),
+                reason="Something went wrong with this request, giving up on it.",
+            )
+        except (disnake.HTTPException, aiohttp.ClientError):
+            qr.request.status = RequestStatus.error
+            WriteBehind.stage_changes(qr.request)
+
+    async def retry(self, qr: QueuedRequest, channel: disnake.abc.Messageable):
+        attempts = qr.request.attempts
+        if attempts >= util.max_attempts:
+            await fail(
+                qr=qr,
+                channel=channel,
+                reason=f"Couldn't reach Stable Diffusion after {attempts} attempts, "
+                "giving up on this request.",
+            )
+            await self.clean_up(qr)
+        else:
+            RequestQueue.retry(qr=qr, delay=util.retry_backoff * 2 ** (attempts - 1))
+
+    async def follow(
+        self,
+        inflight: asyncio.Future,
+        qr: QueuedRequest,
+        channel: disnake.abc.Messageable,
+    ):
+        try:
+            if path := await asyncio.shield(inflight):
+                await reuse(qr=qr, channel=channel, path=path)
+                await self.clean_up(qr)
+            else:
+                await RequestQueue.requeue(qr)
+        finally:
+            RequestQueue.release(qr.entry.request_id)
+
+    @tasks.loop(seconds=util.health_check_interval)
+    async def health_check(self):
+        await BackendPool.check_health(probe=ping)
+
+    @tasks.loop(seconds=min(util.breaker_cooldown, util.health_check_interval))
+    async def recover(self):
+        await BackendPool.check_recovered(probe=ping)
+
+    @tasks.loop(seconds=util.reap_interval)
+    async def reap(self):
+        await RequestQueue.reap()
 
     @dequeue.before_loop
+    async def restore_queue(self):
+        await self.bot.wait_until_ready()
+        # Pick up whatever the last run left queued before taking new requests
+        if not RequestQueue.populated:
+            await RequestQueue.populate()
+
+    @health_check.before_loop
+    @recover.before_loop
+    @reap.before_loop
     async def wait_until_ready(self):
         await self.bot.wait_until_ready()
@@ -4,7 +4,10 @@ import disnake
 from disnake.ext import commands
 
 import emotes
+import metrics
 import util
+from models.embed import EmbedBuilder, Field
+from models.request_queue import RequestQueue
 from util import Interaction
 
 
@@ -59,4 +62,28 @@ class Misc(commands.Cog):
     async def unpause(self, inter: Interaction):
         if inter.author.id == 189101288083030017:
             util.paused = False
+            RequestQueue.notify()
         await inter.response.send_message("Aiba is now unpaused.", ephemeral=True)
+
+    @commands.slash_command(name="stats")
+    async def stats(self, inter: Interaction):
+        if inter.author.id != 189101288083030017:
+            await inter.response.send_message(
+                "Only the bot owner can view stats.", ephemeral=True
+            )
+            return
+        builder = EmbedBuilder(
+            title="Aiba Stats",
+            fields=[
+                Field(name="Queue Length", value=await RequestQueue.get_length()),
+                *(
+                    Field(name=name, value=timing.summary(), inline=False)
+                    for name, timing in metrics.timings.items()
+                ),
+                *(
+                    Field(name=name, value=count)
+                    for name, count in metrics.counters.items()
+                ),
+            ],
+        )
+        await inter.response.send_message(embed=await builder.build(), ephemeral=True)
@@ -1,10 +1,32 @@
+from datetime import datetime, timedelta, timezone
+
+import disnake
 from disnake.ext import commands
 
+from models.caches import WriteBehind
 from models.embed import Field, EmbedBuilder
 from models.guild import Guild
+from models.guild_member import GuildMember
+from models.predictor import format_duration
+from models.request import Request
 from models.user import User
+from models.view import RecordsView
 from util import Interaction
 
+windows = {"all": None, "month": 30, "week": 7}
+window_names = {"all": "All Time", "month": "Past 30 Days", "week": "Past 7 Days"}
+titles = {
+    "requests": "Most Frequent Aiba Users",
+    "score": "Highest Scoring Aiba Users",
+    "gpu_seconds": "Aiba Users by GPU Time",
+    "images": "Most Liked Aiba Images",
+}
+formats = {
+    "requests": lambda total: f"{total} requests",
+    "score": lambda total: f"{total} points",
+    "gpu_seconds": format_duration,
+}
+
 
 class Records(commands.Cog):
     def __init__(self, bot: commands.Bot):
@@ -15,25 +37,146 @@ class Records(commands.Cog):
         description="Provides a list of the 10 people who have used the bot the most in this server.",
         dm_permission=False,
     )
-    async def top_users(self, inter: Interaction):
-        guild = await Guild.find_or_create(disnake_guild=inter.guild)
-        # Dictionaries don't preserve order!!
-        # Get all users in guild as a pair of ids and runs
-        data_list = [
-            {"id": key, "runs": stats.requests} for key, stats in guild.users.items()
-        ]
-        # Sort them by runs, and grab the top 10
-        top = [
-            datum for datum in sorted(data_list, key=lambda x: x["runs"], reverse=True)
-        ][:10]
-        # Make a formatter string to represent the field value in the response embed
+    async def top_users(
+        self,
+        inter: Interaction,
+        ranking: str = commands.Param(
+            default="requests",
+            choices={
+                "Requests": "requests",
+                "Score": "score",
+                "GPU Time": "gpu_seconds",
+                "Most Liked Images": "images",
+            },
+        ),
+        window: str = commands.Param(
+            default="all",
+            choices={"All Time": "all", "Past 30 Days": "month", "Past 7 Days": "week"},
+        ),
+    ):
+        """
+        Provides a list of the 10 people who have used the bot the most in this server.
+
+        Parameters
+        ----------
+        ranking: What to rank by, or the most liked images instead of people
+        window: How far back to count
+        """
+        guild_id = str(inter.guild_id)
+        since = None
+        if (days := windows[window]) is not None:
+            since = datetime.utcnow() - timedelta(days=days)
+        # Counts and new requests are written behind, get them in before ranking
+        await WriteBehind.flush()
+        if ranking == "images":
+            fields = [
+                f"{image.original_prompt[:100]} by "
+                f"{User.construct_mention(image.requestor_id)}: {image.score} points"
+                + (
+                    f" ([image]({image.output_message_url}))"
+                    if image.output_message_url
+                    else ""
+                )
+                for image in await Request.top_images(guild_id=guild_id, since=since)
+            ]
+        else:
+            if since is None:
+                top = [
+                    (member.user_id, getattr(member, ranking))
+                    for member in await GuildMember.top(guild_id=guild_id, by=ranking)
+                ]
+            else:
+                top = await Request.top_requestors(
+                    guild_id=guild_id, by=ranking, since=since
+                )
+            # Make a formatter string to represent the field value in the response embed
+            fields = [
+                f"{User.construct_mention(user_id)}: {formats[ranking](total)}"
+                for user_id, total in top
+            ]
+        builder = EmbedBuilder(
+            title=f"{titles[ranking]} in {inter.guild.name}",
+            description=window_names[window],
+            # Grab those formatted strings
+            fields=[
+                Field(name=index, value=field, inline=False)
+                for index, field in enumerate(fields, 1)
+            ],
+        )
+        await inter.response.send_message(embed=await builder.build())
+
+    @commands.slash_command(
+        name="history",
+        description="Browse past generations in this server, yours or someone else's.",
+        dm_permission=False,
+    )
+    async def history(
+        self,
+        inter: Interaction,
+        user: disnake.User = None,
+        everyone: bool = False,
+    ):
+        """
+        Browse past generations in this server, yours or someone else's.
+
+        Parameters
+        ----------
+        user: Whose generations to browse, yours if not given
+        everyone: Browse everyone's generations in this server instead
+        """
+        # New requests are written behind, get them in before paging
+        await WriteBehind.flush()
+        view = RecordsView(
+            guild_id=str(inter.guild_id),
+            user_id=None if everyone else str((user or inter.author).id),
+        )
+        await inter.response.send_message(
+            **await view.first(), view=view, ephemeral=True
+        )
+
+    @commands.slash_command(
+        name="search",
+        description="Search the prompts of past generations in this server.",
+        dm_permission=False,
+    )
+    async def search(
+        self,
+        inter: Interaction,
+        text: str,
+        user: disnake.User = None,
+        days: commands.Range[1, 3650] = None,
+    ):
+        """
+        Search the prompts of past generations in this server.
+
+        Parameters
+        ----------
+        text: Words to look for, "quotes" for an exact phrase, -word to leave one out
+        user: Only search generations by this user
+        days: Only search generations from the past this many days
+        """
+        await WriteBehind.flush()
+        results = await Request.search(
+            guild_id=str(inter.guild_id),
+            text=text,
+            requestor_id=str(user.id) if user is not None else None,
+            since=datetime.utcnow() - timedelta(days=days) if days else None,
+        )
         fields = [
-            f"{User.construct_mention(datum['id'])}: {datum['runs']} requests"
-            for datum in top
+            f"{(result.original_prompt or result.prompt)[:200]} by "
+            f"{User.construct_mention(result.requestor_id)}, "
+            f"<t:{int(result.date.replace(tzinfo=timezone.utc).timestamp())}:d>: "
+            f"{result.score} points"
+            + (
+                f" ([image]({result.output_message_url}))"
+                if result.output_message_url
+                else ""
+            )
+            for result in results
         ]
         builder = EmbedBuilder(
-            title=f"Most Frequent Aiba Users in {guild.name}",
-            # Grab those formatted strings
+            title=f"Prompts Matching {text}"[:256],
+            description=None if fields else "Nothing matched.",
             fields=[
                 Field(name=index, value=field, inline=False)
                 for index, field in enumerate(fields, 1)
@@ -50,16 +193,20 @@ class Records(commands.Cog):
         guild = await Guild.find_or_create(disnake_guild=inter.guild)
         if username is not None:
             if user := await User.find_by_username(username=username):
-                if user.discord_id in guild.users.keys():
-                    field_val = f"{username} has used Aiba {guild.users[user.discord_id].requests} times."
+                if member := await GuildMember.find_member(
+                    guild_id=guild.discord_id, user_id=user.discord_id
+                ):
+                    field_val = f"{username} has used Aiba {member.requests} times."
                 else:
                     field_val = f"{username} has not used Aiba in this server."
             else:
                 field_val = f"{username} has not used Aiba."
         else:
             if user := await User.find_or_create(disnake_user=inter.author):
-                if user.discord_id in guild.users.keys():
-                    field_val = f"You have used Aiba {guild.users[user.discord_id].requests} times."
+                if member := await GuildMember.find_member(
+                    guild_id=guild.discord_id, user_id=user.discord_id
+                ):
+                    field_val = f"You have used Aiba {member.requests} times."
                 else:
                     field_val = f"You have not used Aiba in this server."
             else:
@@ -0,0 +1,146 @@
+# In-process counters and timings, reported through /stats
+import asyncio
+import logging
+from collections import deque
+from typing import Deque, Dict, Optional, Set
+
+from pymongo import monitoring
+from pymongo.errors import PyMongoError
+
+from util import slow_query_ms
+
+logger = logging.getLogger("disnake")
+
+# How many of the most recent observations each timing keeps for percentiles
+window = 1000
+
+
+class Timing:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.recent: Deque[float] = deque(maxlen=window)
+
+    def observe(self, value: float):
+        self.count += 1
+        self.total += value
+        self.recent.append(value)
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, pct: float) -> float:
+        if not self.recent:
+            return 0.0
+        ordered = sorted(self.recent)
+        return ordered[min(int(len(ordered) * pct / 100), len(ordered) - 1)]
+
+    def summary(self) -> str:
+        return (
+            f"n={self.count}, mean={self.mean:.2f}s, "
+            f"p50={self.percentile(50):.2f}s, p95={self.percentile(95):.2f}s"
+        )
+
+
+counters: Dict[str, int] = {}
+timings: Dict[str, Timing] = {}
+
+
+def increment(name: str, amount: int = 1):
+    counters[name] = counters.get(name, 0) + amount
+
+
+def observe(name: str, value: float):
+    timings.setdefault(name, Timing()).observe(value)
+
+
+class SlowQueryListener(monitoring.CommandListener):
+    """
+    Logs database commands that take longer than `slow_query_ms`, and explains
+    each new shape of slow query to find the ones scanning a whole collection
+    for want of an index.
+
+    Motor runs commands on worker threads, so the explaining and the counters
+    are handed back to the event loop.
+    """
+
+    watched = {"find", "aggregate", "count", "distinct", "update", "delete"}
+
+    def __init__(self):
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.database = None
+        self.commands: Dict[int, dict] = {}
+        self.explained: Set[tuple] = set()
+
+    def attach(self, database):
+        """Start explaining slow queries against `database` from the running loop."""
+        self.loop = asyncio.get_running_loop()
+        self.database = database
+
+    def started(self, event: monitoring.CommandStartedEvent):
+        if event.command_name in self.watched:
+            self.commands[event.request_id] = dict(event.command)
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent):
+        command = self.commands.pop(event.request_id, None)
+        seconds = event.duration_micros / 1e6
+        if command is None or seconds * 1000 < slow_query_ms or self.loop is None:
+            return
+        self.loop.call_soon_threadsafe(
+            self.report, event.command_name, command, seconds
+        )
+
+    def failed(self, event: monitoring.CommandFailedEvent):
+        self.commands.pop(event.request_id, None)
+
+    def report(self, name: str, command: dict, seconds: float):
+        increment("slow_queries")
+        collection = command.get(name)
+        logger.warning(f"Slow {name} on {collection} took {seconds:.2f}s: {command}")
+        shape = (name, collection, tuple(sorted(query_filter(name, command))))
+        if shape not in self.explained:
+            self.explained.add(shape)
+            asyncio.create_task(self.explain(name, collection, command))
+
+    async def explain(self, name: str, collection: str, command: dict):
+        # Drop the session and cluster fields the driver adds, explain adds its own
+        command = {
+            k: v for k, v in command.items() if not k.startswith("$") and k != "lsid"
+        }
+        try:
+            plan = await self.database.command(
+                {"explain": command, "verbosity": "queryPlanner"}
+            )
+        except PyMongoError:
+            return
+        if scans_collection(plan):
+            increment("unindexed_queries")
+            logger.warning(
+                f"Slow {name} on {collection} has no index to use, filtering on "
+                f"{sorted(query_filter(name, command))}"
+            )
+
+
+def query_filter(name: str, command: dict) -> dict:
+    match name:
+        case "find" | "count" | "distinct":
+            return command.get("filter") or command.get("query") or {}
+        case "aggregate":
+            first = (command.get("pipeline") or [{}])[0]
+            return first.get("$match", {})
+        case "update":
+            return (command.get("updates") or [{}])[0].get("q", {})
+        case "delete":
+            return (command.get("deletes") or [{}])[0].get("q", {})
+    return {}
+
+
+def scans_collection(plan) -> bool:
+    if isinstance(plan, dict):
+        return plan.get("stage") == "COLLSCAN" or any(
+            scans_collection(v) for v in plan.values()
+        )
+    if isinstance(plan, list):
+        return any(scans_collection(v) for v in plan)
+    return False
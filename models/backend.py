@@ -0,0 +1,158 @@
+import asyncio
+import time
+from typing import List, Optional
+
+from pydantic import BaseModel
+
+import metrics
+from util import (
+    backends,
+    default_backend_concurrency,
+    breaker_threshold,
+    breaker_cooldown,
+    breaker_max_cooldown,
+)
+
+
+class Backend(BaseModel):
+    url: str
+    limit: int = 1
+    in_flight: int = 0
+    healthy: bool = True
+    # Consecutive failed calls, and how many times in a row it's been taken out
+    failures: int = 0
+    trips: int = 0
+    # When a backend out of rotation is next probed, on the monotonic clock
+    retry_at: float = 0.0
+    # The checkpoint it has loaded, once known
+    checkpoint: Optional[str] = None
+
+    @property
+    def load(self) -> float:
+        return self.in_flight / self.limit
+
+    @property
+    def available(self) -> bool:
+        return self.healthy and self.in_flight < self.limit
+
+    @classmethod
+    def from_entry(cls, entry: str) -> "Backend":
+        # Entries look like "http://host:7860" or "http://host:7860|2", where the
+        # optional suffix is the number of generations the backend runs at once.
+        url, _, limit = entry.partition("|")
+        return cls(
+            url=url.strip().rstrip("/"),
+            limit=max(int(limit), 1) if limit else default_backend_concurrency,
+        )
+
+
+class BackendPool:
+    backends: List[Backend] = None
+    populated: bool = False
+    # Set whenever a backend slot may have opened up
+    freed: asyncio.Event = None
+
+    @classmethod
+    def populate(cls):
+        cls.populated = True
+        cls.backends = [Backend.from_entry(entry) for entry in backends]
+        cls.freed = asyncio.Event()
+
+    @classmethod
+    def get_backends(cls) -> List[Backend]:
+        if not cls.populated:
+            cls.populate()
+        return cls.backends
+
+    @classmethod
+    def try_acquire(cls, prefer: str = None) -> Optional[Backend]:
+        """
+        Reserve a slot on the least-loaded healthy backend, if any has room. Backends
+        with the `prefer` checkpoint loaded go first, so each checkpoint stays warm
+        on the backends already running it.
+        """
+        candidates = [backend for backend in cls.get_backends() if backend.available]
+        if not candidates:
+            return None
+        backend = min(
+            candidates,
+            key=lambda b: (prefer is not None and b.checkpoint != prefer, b.load),
+        )
+        backend.in_flight += 1
+        return backend
+
+    @classmethod
+    async def acquire(cls, prefer: str = None) -> Backend:
+        """Wait for a free slot and reserve it, as in try_acquire."""
+        while not (backend := cls.try_acquire(prefer=prefer)):
+            cls.freed.clear()
+            await cls.freed.wait()
+        return backend
+
+    @classmethod
+    def release(cls, backend: Backend):
+        backend.in_flight = max(backend.in_flight - 1, 0)
+        cls.freed.set()
+
+    @classmethod
+    def mark(cls, backend: Backend, healthy: bool):
+        backend.healthy = healthy
+        if healthy:
+            cls.freed.set()
+
+    @classmethod
+    def record_success(cls, backend: Backend):
+        backend.failures = 0
+        backend.trips = 0
+        if not backend.healthy:
+            cls.mark(backend, healthy=True)
+
+    @classmethod
+    def record_failure(cls, backend: Backend, trip: bool = False):
+        backend.failures += 1
+        if trip or backend.failures >= breaker_threshold:
+            cls.trip(backend)
+
+    @classmethod
+    def trip(cls, backend: Backend):
+        """Take `backend` out of rotation until a probe finds it working again."""
+        cooldown = min(breaker_cooldown * 2**backend.trips, breaker_max_cooldown)
+        backend.trips += 1
+        backend.retry_at = time.monotonic() + cooldown
+        # It may well come back restarted, with its default checkpoint
+        backend.checkpoint = None
+        if backend.healthy:
+            metrics.increment("breaker_trips")
+        cls.mark(backend, healthy=False)
+
+    @classmethod
+    async def probe(cls, probe, backends_: List[Backend]):
+        """Run `probe` against the given backends concurrently and update rotation."""
+        results = await asyncio.gather(
+            *(probe(backend) for backend in backends_), return_exceptions=True
+        )
+        for backend, result in zip(backends_, results):
+            if result is True:
+                cls.record_success(backend)
+            else:
+                cls.trip(backend)
+
+    @classmethod
+    async def check_health(cls, probe):
+        """Probe the backends in rotation, to notice ones that went away."""
+        await cls.probe(
+            probe, [backend for backend in cls.get_backends() if backend.healthy]
+        )
+
+    @classmethod
+    async def check_recovered(cls, probe):
+        """Probe the backends out of rotation whose cooldown has run out."""
+        now = time.monotonic()
+        await cls.probe(
+            probe,
+            [
+                backend
+                for backend in cls.get_backends()
+                if not backend.healthy and backend.retry_at <= now
+            ],
+        )
@@ -0,0 +1,402 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, Type
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from beanie import Document, PydanticObjectId
+from beanie.odm.utils.dump import get_dict
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+
+import metrics
+from util import (
+    outputs_dir,
+    result_cache_bytes,
+    input_cache_bytes,
+    document_cache_size,
+    document_cache_ttl,
+)
+
+logger = logging.getLogger("disnake")
+
+result_cache_dir = os.path.join(outputs_dir, "cache")
+
+
+def link_or_copy(src: str, dst: str):
+    # Hard links let the cache and any number of requests share one copy on disk
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+class ResultCache:
+    """
+    Finished images, addressed by a hash of the payload that produced them.
+
+    Entries are hard links under outputs/cache, so the directory itself is the
+    index and survives restarts. The least recently used entries are unlinked
+    once the cache grows past `result_cache_bytes`; request outputs elsewhere in
+    outputs/ are never touched.
+    """
+
+    entries: "OrderedDict[str, int]" = None
+    total_bytes: int = 0
+    # Keys currently being generated, for collapsing identical requests into one
+    inflight: Dict[str, asyncio.Future] = None
+    populated: bool = False
+
+    @classmethod
+    def populate(cls):
+        cls.populated = True
+        cls.entries = OrderedDict()
+        cls.total_bytes = 0
+        cls.inflight = {}
+        os.makedirs(result_cache_dir, exist_ok=True)
+        with os.scandir(result_cache_dir) as it:
+            files = sorted(
+                (entry for entry in it if entry.is_file()),
+                key=lambda entry: entry.stat().st_mtime,
+            )
+        for entry in files:
+            size = entry.stat().st_size
+            cls.entries[os.path.splitext(entry.name)[0]] = size
+            cls.total_bytes += size
+
+    @staticmethod
+    def key_for(payload: dict) -> str:
+        normalized = json.dumps(payload, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(normalized.encode()).hexdigest()
+
+    @staticmethod
+    def path_for(key: str) -> str:
+        return os.path.join(result_cache_dir, f"{key}.png")
+
+    @classmethod
+    def lookup(cls, key: str, count_misses: bool = True) -> Optional[str]:
+        """
+        The cached image for `key`, if there is one. Pass `count_misses=False` when the
+        request will be looked up again if it misses, so it's only counted once.
+        """
+        if not cls.populated:
+            cls.populate()
+        path = cls.path_for(key)
+        if key in cls.entries and os.path.exists(path):
+            cls.entries.move_to_end(key)
+            # Keep recency across restarts, since they're reloaded by mtime
+            os.utime(path)
+            metrics.increment("result_cache_hits")
+            return path
+        if key in cls.entries:
+            cls.total_bytes -= cls.entries.pop(key)
+        if count_misses:
+            metrics.increment("result_cache_misses")
+        return None
+
+    @classmethod
+    def claim(cls, key: str):
+        """Mark `key` as being generated, so identical requests wait for it."""
+        if not cls.populated:
+            cls.populate()
+        cls.inflight[key] = asyncio.get_running_loop().create_future()
+
+    @classmethod
+    def get_inflight(cls, key: str) -> Optional[asyncio.Future]:
+        """
+        The in-flight generation of `key` to wait on, if there is one. It resolves
+        to the finished image, or None if the generation didn't finish.
+        """
+        if cls.inflight is not None and (future := cls.inflight.get(key)):
+            metrics.increment("result_cache_collapsed")
+            return future
+
+    @classmethod
+    def store(cls, key: str, output_path: str):
+        if not cls.populated:
+            cls.populate()
+        path = cls.path_for(key)
+        if key not in cls.entries and result_cache_bytes > 0:
+            if os.path.exists(path):
+                os.remove(path)
+            link_or_copy(output_path, path)
+            cls.entries[key] = os.path.getsize(path)
+            cls.total_bytes += cls.entries[key]
+            cls.evict()
+        cls.resolve(key, path if key in cls.entries else output_path)
+
+    @classmethod
+    def abandon(cls, key: str):
+        cls.resolve(key, None)
+
+    @classmethod
+    def resolve(cls, key: str, path: Optional[str]):
+        if (future := cls.inflight.pop(key, None)) and not future.done():
+            future.set_result(path)
+
+    @classmethod
+    def evict(cls):
+        while cls.total_bytes > result_cache_bytes and cls.entries:
+            key, size = cls.entries.popitem(last=False)
+            cls.total_bytes -= size
+            try:
+                os.remove(cls.path_for(key))
+            except FileNotFoundError:
+                pass
+
+
+class InputCache:
+    """
+    Img2Img inputs, already downscaled and base64 encoded, keyed by attachment and
+    the size they were prepared for. Kept in memory, least recently used first out.
+    """
+
+    entries: "OrderedDict[Tuple[str, int, int], str]" = OrderedDict()
+    total_bytes: int = 0
+
+    # Discord signs attachment URLs with parameters that change over time
+    signed_hosts = {"cdn.discordapp.com", "media.discordapp.net"}
+    signature_params = {"ex", "is", "hm"}
+
+    @classmethod
+    def key_for(cls, url: str, width: int, height: int) -> Tuple[str, int, int]:
+        parts = urlsplit(url)
+        if parts.hostname in cls.signed_hosts:
+            # Anything else in the query, e.g. media proxy sizing, changes the image
+            query = [
+                (name, value)
+                for name, value in parse_qsl(parts.query, keep_blank_values=True)
+                if name not in cls.signature_params
+            ]
+            url = urlunsplit(parts._replace(query=urlencode(query)))
+        return url, width, height
+
+    @classmethod
+    def get(cls, url: str, width: int, height: int) -> Optional[str]:
+        key = cls.key_for(url, width, height)
+        if (data := cls.entries.get(key)) is not None:
+            cls.entries.move_to_end(key)
+            metrics.increment("input_cache_hits")
+            return data
+        metrics.increment("input_cache_misses")
+
+    @classmethod
+    def put(cls, url: str, width: int, height: int, data: str):
+        key = cls.key_for(url, width, height)
+        if key in cls.entries:
+            cls.total_bytes -= len(cls.entries.pop(key))
+        if len(data) > input_cache_bytes:
+            return
+        cls.entries[key] = data
+        cls.total_bytes += len(data)
+        while cls.total_bytes > input_cache_bytes:
+            cls.total_bytes -= len(cls.entries.popitem(last=False)[1])
+
+
+class WriteBehind:
+    """
+    Buffers writes to documents and sends them out together in one bulk write
+    per collection, instead of one round trip each. New documents are held as
+    inserts until the next flush, so any changes made to them before then go
+    out with the insert.
+    """
+
+    pending: Dict[Tuple[Type[Document], Any], Dict[str, Dict[str, Any]]] = {}
+    inserts: Dict[Tuple[Type[Document], Any], Document] = {}
+    # Flushes run one at a time so an update can never overtake its insert
+    lock: asyncio.Lock = None
+
+    @classmethod
+    def stage(
+        cls, doc: Document, inc: Dict[str, int] = None, set_: Dict[str, Any] = None
+    ):
+        """
+        Queue an update for `doc`, whose in-memory copy the caller has already
+        changed to match.
+        """
+        cls.merge(key=(type(doc), doc.id), inc=inc or {}, set_=set_ or {})
+        # The change is on its way to the database, so stop save_changes from
+        # writing it out a second time
+        doc._save_state()
+
+    @classmethod
+    def stage_insert(cls, doc: Document):
+        """Queue `doc` to be inserted, giving it its id straight away."""
+        if doc.id is None:
+            doc.id = PydanticObjectId()
+        cls.inserts[(type(doc), doc.id)] = doc
+        doc._save_state()
+
+    @classmethod
+    def stage_changes(cls, doc: Document):
+        """Queue whatever fields of `doc` changed since it was last written."""
+        if (type(doc), doc.id) in cls.inserts:
+            # Still waiting to be inserted, and the insert will carry the changes
+            doc._save_state()
+        elif changes := doc.get_changes():
+            cls.stage(doc, set_=changes)
+
+    @classmethod
+    def stage_upsert(
+        cls,
+        doc_cls: Type[Document],
+        match: Dict[str, Any],
+        inc: Dict[str, int] = None,
+        set_: Dict[str, Any] = None,
+    ):
+        """
+        Queue an update for the `doc_cls` document matching `match`, creating it if
+        there isn't one yet.
+        """
+        key = (doc_cls, tuple(sorted(match.items())))
+        cls.merge(key=key, inc=inc or {}, set_=set_ or {})
+
+    @classmethod
+    def merge(cls, key: tuple, inc: Dict[str, int], set_: Dict[str, Any]):
+        update = cls.pending.setdefault(key, {})
+        for path, amount in inc.items():
+            incs = update.setdefault("$inc", {})
+            incs[path] = incs.get(path, 0) + amount
+        if set_:
+            update.setdefault("$set", {}).update(set_)
+
+    @classmethod
+    def has_pending(cls, doc: Document) -> bool:
+        key = (type(doc), doc.id)
+        return key in cls.pending or key in cls.inserts
+
+    @classmethod
+    async def flush(cls):
+        if cls.lock is None:
+            cls.lock = asyncio.Lock()
+        async with cls.lock:
+            if not cls.pending and not cls.inserts:
+                return
+            pending, cls.pending = cls.pending, {}
+            inserts, cls.inserts = cls.inserts, {}
+            # Subclasses of a document share their root's collection
+            by_collection: Dict[str, Tuple[Type[Document], list, dict]] = {}
+            for (doc_cls, doc_id), doc in inserts.items():
+                name = doc_cls.get_motor_collection().name
+                by_collection.setdefault(name, (doc_cls, [], {}))[1].append(doc)
+            for (doc_cls, doc_id), update in pending.items():
+                name = doc_cls.get_motor_collection().name
+                by_collection.setdefault(name, (doc_cls, [], {}))[2][
+                    (doc_cls, doc_id)
+                ] = update
+            for doc_cls, docs, updates in by_collection.values():
+                await cls.write(doc_cls=doc_cls, docs=docs, updates=updates)
+
+    @classmethod
+    async def write(
+        cls,
+        doc_cls: Type[Document],
+        docs: List[Document],
+        updates: Dict[Tuple[Type[Document], Any], dict],
+    ):
+        # Inserts are listed first and the write is ordered, so updates to a
+        # document inserted in the same flush land after it
+        ops = [
+            InsertOne(
+                get_dict(doc, to_db=True, keep_nulls=doc.get_settings().keep_nulls)
+            )
+            for doc in docs
+        ] + [
+            # Upserts are keyed by their match instead of an id
+            (
+                UpdateOne(dict(doc_id), u, upsert=True)
+                if isinstance(doc_id, tuple)
+                else UpdateOne({"_id": doc_id}, u)
+            )
+            for (_, doc_id), u in updates.items()
+        ]
+        metrics.increment("bulk_writes")
+        metrics.increment("bulk_write_ops", len(ops))
+        try:
+            await doc_cls.get_motor_collection().bulk_write(ops)
+        except BulkWriteError as e:
+            # Retrying the one that was rejected won't help, but the rest of an
+            # ordered write stopped with it
+            errors = e.details["writeErrors"]
+            logger.error(f"Write-behind writes rejected: {errors}")
+            failed = errors[0]["index"]
+            cls.requeue(
+                docs=docs[failed + 1 :],
+                updates=dict(list(updates.items())[max(failed + 1 - len(docs), 0) :]),
+            )
+        except PyMongoError:
+            logger.exception("Write-behind flush failed, retrying next time")
+            cls.requeue(docs=docs, updates=updates)
+
+    @classmethod
+    def requeue(
+        cls, docs: List[Document], updates: Dict[Tuple[Type[Document], Any], dict]
+    ):
+        for doc in docs:
+            cls.inserts.setdefault((type(doc), doc.id), doc)
+        for key, update in updates.items():
+            cls.merge(key=key, inc=update.get("$inc", {}), set_=update.get("$set", {}))
+
+
+class DocumentCache:
+    """
+    An in-process, read-through cache of documents keyed by discord id, with
+    LRU eviction, a TTL, and single-flight loading so concurrent misses for the
+    same key share one query.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries: "OrderedDict[str, Tuple[float, Document]]" = OrderedDict()
+        self.loading: Dict[str, asyncio.Future] = {}
+
+    async def get(self, key: str, loader: Callable[[], Awaitable[Document]]):
+        if entry := self.entries.get(key):
+            expires, doc = entry
+            # Expired documents are kept while they have writes waiting, since
+            # reloading them would lose those
+            if expires > time.monotonic() or WriteBehind.has_pending(doc):
+                self.entries.move_to_end(key)
+                metrics.increment("document_cache_hits")
+                return doc
+            del self.entries[key]
+        if key in self.loading:
+            return await asyncio.shield(self.loading[key])
+        metrics.increment("document_cache_misses")
+        future = asyncio.get_running_loop().create_future()
+        self.loading[key] = future
+        try:
+            doc = await loader()
+        except Exception as e:
+            future.set_exception(e)
+            # Nobody may be waiting on it, don't warn about it going unretrieved
+            future.exception()
+            raise
+        finally:
+            self.loading.pop(key, None)
+        self.put(key, doc)
+        future.set_result(doc)
+        return doc
+
+    def peek(self, key: str) -> Optional[Document]:
+        if entry := self.entries.get(key):
+            return entry[1]
+
+    def put(self, key: str, doc: Document):
+        self.entries[key] = (time.monotonic() + self.ttl, doc)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, key: str):
+        self.entries.pop(key, None)
+
+
+guilds = DocumentCache(max_size=document_cache_size, ttl=document_cache_ttl)
+users = DocumentCache(max_size=document_cache_size, ttl=document_cache_ttl)
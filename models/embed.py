@@ -21,17 +21,20 @@ class EmbedBuilder(BaseModel):
 
     title: str
     description: Optional[str]
+    url: Optional[str]
     timestamp: Optional[datetime]
     fields: Optional[List[Field]]
     thumbnail_url: Optional[str]
     thumbnail_file: Optional[File]
     image: Optional[File]
+    image_url: Optional[str]
 
     async def build(self) -> Embed:
         self.fields = self.fields if self.fields is not None else []
         embed = Embed(
             title=self.title,
             description=self.description,
+            url=self.url,
             color=Colour.dark_teal(),
             timestamp=self.timestamp
             or datetime.utcnow().replace(tzinfo=ZoneInfo("UTC")),
@@ -42,6 +45,8 @@ class EmbedBuilder(BaseModel):
             embed.set_thumbnail(url=self.thumbnail_url)
         elif self.thumbnail_file is not None:
             embed.set_thumbnail(file=self.thumbnail_file)
-        if self.image is not None:
+        if self.image_url is not None:
+            embed.set_image(url=self.image_url)
+        elif self.image is not None:
             embed.set_image(file=self.image)
         return embed
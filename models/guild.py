@@ -1,17 +1,44 @@
 import re
 from enum import Enum
-from typing import List, Dict, Optional, Union
+from typing import List, Optional, Union
 
 import disnake
 from beanie import Document
 from pydantic import BaseModel, validator
+from pymongo import ASCENDING, IndexModel
 
-from models import request
+from models import caches, request
+from models.guild_member import GuildMember
 from models.embed import EmbedBuilder, Field
 
 
 class SamplerIndices(Enum):
     euler = "Euler"
+    dpmpp_2m_karras = "DPM++ 2M Karras"
+    dpmpp_sde = "DPM++ SDE"
+    unipc = "UniPC"
+    # Only gives good results with an LCM checkpoint or LoRA
+    lcm = "LCM"
+
+    @property
+    def evals_per_step(self) -> int:
+        # SDE samplers run the model twice a step
+        return 2 if self == SamplerIndices.dpmpp_sde else 1
+
+
+class SamplerPresets(Enum):
+    """Sampler, steps and CFG scale that work well together, best quality first."""
+
+    quality = ("Quality", SamplerIndices.dpmpp_2m_karras, 30, 7)
+    balanced = ("Balanced", SamplerIndices.dpmpp_2m_karras, 20, 7)
+    fast = ("Fast", SamplerIndices.unipc, 10, 7)
+    lcm = ("LCM", SamplerIndices.lcm, 6, 2)
+
+    def __init__(self, title: str, sampler: SamplerIndices, steps: int, cfg_scale):
+        self.title = title
+        self.sampler = sampler
+        self.steps = steps
+        self.cfg_scale = cfg_scale
 
 
 class GuildSettings(BaseModel):
@@ -27,8 +54,12 @@ class GuildSettings(BaseModel):
     steps_override: bool = True
     visible_prompts: bool = True
     delete_prompts: bool = True
+    # This server's share of the queue relative to others, when fair queueing is on
+    queue_weight: float = 1.0
+    # The WebUI checkpoint title to generate with, or None for whatever is loaded
+    checkpoint: Optional[str] = None
 
-    @validator("neg_prompt")
+    @validator("neg_prompt", always=True)
     def default_neg_prompt(cls, v):
         return (
             v
@@ -56,7 +87,7 @@ class GuildSettings(BaseModel):
             ]
         )
 
-    @validator("prompt_improvement")
+    @validator("prompt_improvement", always=True)
     def default_prompt_improvement(cls, v):
         return v if v is not None else ["(masterpiece: 1.5)", "(best quality: 1.5)"]
 
@@ -68,6 +99,21 @@ class GuildSettings(BaseModel):
     def prompt_improvement_string(self):
         return ", ".join([tag for tag in self.prompt_improvement])
 
+    @property
+    def preset(self) -> Optional[SamplerPresets]:
+        for preset in SamplerPresets:
+            if (self.sampler_index, self.steps, self.cfg_scale) == (
+                preset.sampler,
+                preset.steps,
+                preset.cfg_scale,
+            ):
+                return preset
+
+    def apply_preset(self, preset: SamplerPresets):
+        self.sampler_index = preset.sampler
+        self.steps = preset.steps
+        self.cfg_scale = preset.cfg_scale
+
     async def get_overview_embed(self):
         builder = EmbedBuilder(
             title="Aiba Configuration",
@@ -87,6 +133,12 @@ class GuildSettings(BaseModel):
                 Field(name="Resolution", value=f"{self.width}x{self.height}"),
                 Field(name="Denoising Strength", value=self.denoising_strength),
                 Field(name="Sampler Index", value=self.sampler_index.value),
+                Field(
+                    name="Preset",
+                    value=self.preset.title if self.preset else "Custom",
+                ),
+                Field(name="Queue Weight", value=self.queue_weight),
+                Field(name="Checkpoint", value=self.checkpoint or "Default"),
                 Field(
                     name="Automatic Prompt Improvement",
                     value=self.prompt_improvement_string,
@@ -98,46 +150,45 @@ class GuildSettings(BaseModel):
         return await builder.build()
 
 
-class GuildUserStats(BaseModel):
-    name: Optional[str]
-    requests: int = 0
-
-
 class Guild(Document):
     class Settings:
         use_state_management = True
         state_management_replace_objects = True
         name = "guild"
+        indexes = [IndexModel([("discord_id", ASCENDING)], unique=True)]
 
     discord_id: str
     name: str
     settings: GuildSettings = None
-    users: Dict[str, GuildUserStats] = None
 
     @property
     def int_discord_id(self):
         return int(self.discord_id)
 
-    @validator("settings")
+    @validator("settings", always=True)
     def default_settings(cls, v):
         return v if v is not None else GuildSettings()
 
-    @validator("users")
-    def ensure_users(cls, v):
-        return v if v is not None else {}
-
     @classmethod
     async def find_or_create(
         cls, discord_id: int = None, disnake_guild: disnake.Guild = None
     ) -> "Guild":
-        qry_id = disnake_guild.id if disnake_guild is not None else discord_id
-        if extant := await cls.find_one(Guild.discord_id == str(qry_id)):
-            return extant
-        else:
-            return cls(
+        qry_id = str(disnake_guild.id if disnake_guild is not None else discord_id)
+
+        async def load() -> "Guild":
+            if extant := await cls.find_one(Guild.discord_id == qry_id):
+                return extant
+            return await cls(
                 discord_id=qry_id,
                 name=disnake_guild.name if disnake_guild is not None else None,
-            )
+            ).insert()
+
+        return await caches.guilds.get(qry_id, loader=load)
+
+    async def save_settings(self):
+        await self.save_changes()
+        # Make sure the next lookup sees exactly what was written
+        caches.guilds.invalidate(self.discord_id)
 
     @staticmethod
     def clean_prompt(prompt: str):
@@ -225,7 +276,14 @@ class Guild(Document):
             "sampler_index": self.settings.sampler_index.value,
             "width": self.settings.width,
             "height": self.settings.height,
+            "seed": req.seed if req.seed is not None else -1,
         }
+        if self.settings.checkpoint is not None:
+            payload["override_settings"] = {
+                "sd_model_checkpoint": self.settings.checkpoint
+            }
+            # Leave it loaded for the next request rather than swapping straight back
+            payload["override_settings_restore_afterwards"] = False
         if data is not None:
             payload["init_images"] = [data]
             payload["denoising_strength"] = req.denoising_strength
@@ -235,9 +293,4 @@ class Guild(Document):
         self,
         discord_id: str,
     ):
-        if self.users is None:
-            self.users = {}
-        stats = self.users.get(discord_id, GuildUserStats())
-        stats.requests += 1
-        self.users[discord_id] = stats
-        await self.save_changes()
+        GuildMember.log_request(guild_id=self.discord_id, user_id=discord_id)
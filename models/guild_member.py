@@ -0,0 +1,62 @@
+from typing import List, Optional
+
+from beanie import Document
+from pymongo import ASCENDING, DESCENDING, IndexModel
+
+from models.caches import WriteBehind
+
+
+class GuildMember(Document):
+    """
+    How much one user has used the bot in one server. Kept out of the Guild
+    document so that stays the same size however many people use it.
+    """
+
+    class Settings:
+        name = "guild_member"
+        indexes = [
+            IndexModel([("guild_id", ASCENDING), ("user_id", ASCENDING)], unique=True),
+            # Leaderboards, one per thing members are ranked by
+            IndexModel([("guild_id", ASCENDING), ("requests", DESCENDING)]),
+            IndexModel([("guild_id", ASCENDING), ("score", DESCENDING)]),
+            IndexModel([("guild_id", ASCENDING), ("gpu_seconds", DESCENDING)]),
+        ]
+
+    guild_id: str
+    user_id: str
+    name: Optional[str]
+    requests: int = 0
+    # Likes minus dislikes across everything they've generated
+    score: int = 0
+    # Generation time spent on their requests, with batches split evenly
+    gpu_seconds: float = 0.0
+
+    @classmethod
+    def log(cls, guild_id: str, user_id: str, **inc):
+        WriteBehind.stage_upsert(
+            cls, match={"guild_id": guild_id, "user_id": user_id}, inc=inc
+        )
+
+    @classmethod
+    def log_request(cls, guild_id: str, user_id: str):
+        cls.log(guild_id=guild_id, user_id=user_id, requests=1)
+
+    @classmethod
+    async def find_member(cls, guild_id: str, user_id: str) -> Optional["GuildMember"]:
+        # Counts are written behind, so get them out before reading
+        await WriteBehind.flush()
+        return await cls.find_one(
+            GuildMember.guild_id == guild_id, GuildMember.user_id == user_id
+        )
+
+    @classmethod
+    async def top(
+        cls, guild_id: str, by: str = "requests", limit: int = 10
+    ) -> List["GuildMember"]:
+        """The members with the most of `by`, all-time, straight off its index."""
+        return (
+            await cls.find(GuildMember.guild_id == guild_id)
+            .sort((by, DESCENDING))
+            .limit(limit)
+            .to_list()
+        )
@@ -0,0 +1,187 @@
+import logging
+from typing import Callable
+
+from motor.motor_asyncio import AsyncIOMotorCollection, AsyncIOMotorDatabase
+from pymongo import UpdateOne
+
+logger = logging.getLogger("disnake")
+
+
+def union(a: list, b: list) -> list:
+    return list(dict.fromkeys((a or []) + (b or [])))
+
+
+def fold_user(keep: dict, dup: dict):
+    keep["req_count"] = keep.get("req_count", 0) + dup.get("req_count", 0)
+    keep["requests"] = {**(dup.get("requests") or {}), **(keep.get("requests") or {})}
+    keep["guilds"] = union(keep.get("guilds"), dup.get("guilds"))
+    keep["favorites"] = union(keep.get("favorites"), dup.get("favorites"))
+
+
+def fold_guild(keep: dict, dup: dict):
+    users = keep.get("users") or {}
+    for discord_id, stats in (dup.get("users") or {}).items():
+        merged = users.setdefault(discord_id, {"name": None, "requests": 0})
+        merged["name"] = merged.get("name") or stats.get("name")
+        merged["requests"] = merged.get("requests", 0) + stats.get("requests", 0)
+    keep["users"] = users
+
+
+async def has_unique_index(collection: AsyncIOMotorCollection, field: str) -> bool:
+    for index in (await collection.index_information()).values():
+        if index.get("unique") and index["key"] == [(field, 1)]:
+            return True
+    return False
+
+
+async def merge_duplicates(
+    collection: AsyncIOMotorCollection, fold: Callable[[dict, dict], None]
+):
+    """
+    Merge documents that share a discord_id into the oldest of them, so a unique
+    index can be built. Only needed once, before that index exists.
+    """
+    if await has_unique_index(collection, "discord_id"):
+        return
+    pipeline = [
+        {"$group": {"_id": "$discord_id", "ids": {"$push": "$_id"}}},
+        {"$match": {"ids.1": {"$exists": True}}},
+    ]
+    async for group in collection.aggregate(pipeline, allowDiskUse=True):
+        keep, *dups = (
+            await collection.find({"_id": {"$in": group["ids"]}})
+            .sort("_id", 1)
+            .to_list(None)
+        )
+        for dup in dups:
+            fold(keep, dup)
+        await collection.replace_one({"_id": keep["_id"]}, keep)
+        await collection.delete_many({"_id": {"$in": [dup["_id"] for dup in dups]}})
+        logger.warning(
+            f"Merged {len(dups)} duplicate {collection.name} documents into "
+            f"{keep['_id']} (discord_id {group['_id']})"
+        )
+
+
+async def move_guild_users(database: AsyncIOMotorDatabase):
+    """Move each guild's embedded per-user stats out into guild_member."""
+    async for guild in database["guild"].find(
+        {"users": {"$exists": True}}, {"discord_id": 1, "users": 1}
+    ):
+        # Setting rather than incrementing, so a run cut short can be repeated
+        ops = [
+            UpdateOne(
+                {"guild_id": guild["discord_id"], "user_id": user_id},
+                {
+                    "$set": {
+                        "name": stats.get("name"),
+                        "requests": stats.get("requests", 0),
+                    }
+                },
+                upsert=True,
+            )
+            for user_id, stats in (guild["users"] or {}).items()
+        ]
+        if ops:
+            await database["guild_member"].bulk_write(ops)
+        await database["guild"].update_one(
+            {"_id": guild["_id"]}, {"$unset": {"users": ""}}
+        )
+        logger.warning(f"Moved {len(ops)} users out of guild {guild['discord_id']}")
+
+
+async def drop_user_requests(database: AsyncIOMotorDatabase):
+    """
+    Drop the request id to prompt map embedded in each user, which the request
+    collection already has, keeping only how many there were.
+    """
+    result = await database["user"].update_many(
+        {"requests": {"$exists": True}},
+        [
+            {
+                "$set": {
+                    "req_count": {
+                        "$max": [
+                            {"$ifNull": ["$req_count", 0]},
+                            {
+                                "$size": {
+                                    "$objectToArray": {"$ifNull": ["$requests", {}]}
+                                }
+                            },
+                        ]
+                    }
+                }
+            },
+            {"$project": {"requests": 0}},
+        ],
+    )
+    if result.modified_count:
+        logger.warning(f"Dropped embedded requests from {result.modified_count} users")
+
+
+async def backfill_member_totals(database: AsyncIOMotorDatabase):
+    """Work out each member's all-time score and GPU time from their requests."""
+    if await database["migration"].find_one({"_id": "member_totals"}):
+        return
+    pipeline = [
+        {"$match": {"status": "finished"}},
+        {
+            "$group": {
+                "_id": {"guild_id": "$source_guild_id", "user_id": "$requestor_id"},
+                "score": {
+                    "$sum": {
+                        "$subtract": [
+                            {"$ifNull": ["$likes", 0]},
+                            {"$ifNull": ["$dislikes", 0]},
+                        ]
+                    }
+                },
+                "gpu_seconds": {
+                    "$sum": {
+                        "$divide": [
+                            {"$ifNull": ["$runtime", 0]},
+                            {"$ifNull": ["$batch_size", 1]},
+                        ]
+                    }
+                },
+            }
+        },
+    ]
+    ops = []
+    async for group in database["request"].aggregate(pipeline, allowDiskUse=True):
+        ops.append(
+            UpdateOne(
+                group["_id"],
+                {
+                    "$set": {
+                        "score": group["score"],
+                        "gpu_seconds": group["gpu_seconds"],
+                    }
+                },
+                upsert=True,
+            )
+        )
+        if len(ops) >= 1000:
+            await database["guild_member"].bulk_write(ops)
+            ops = []
+    if ops:
+        await database["guild_member"].bulk_write(ops)
+    await database["migration"].insert_one({"_id": "member_totals"})
+
+
+async def drop_superseded_indexes(database: AsyncIOMotorDatabase):
+    # Replaced by the same indexes with _id on the end, which cover the same queries
+    indexes = await database["request"].index_information()
+    for name in ("requestor_id_1_date_-1", "source_guild_id_1_date_-1"):
+        if name in indexes:
+            await database["request"].drop_index(name)
+
+
+async def migrate(database: AsyncIOMotorDatabase):
+    """Bring existing data up to date. Runs before the models are initialised."""
+    await merge_duplicates(database["user"], fold_user)
+    await merge_duplicates(database["guild"], fold_guild)
+    await move_guild_users(database)
+    await drop_user_requests(database)
+    await backfill_member_totals(database)
+    await drop_superseded_indexes(database)
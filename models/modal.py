@@ -1,6 +1,7 @@
 import disnake
 from disnake import TextInputStyle
 
+import metrics
 from models.request import Img2ImgRequest
 from models.request_queue import RequestQueue
 from models.guild import Guild
@@ -55,6 +56,12 @@ class Img2ImgModal(disnake.ui.Modal):
             await inter.response.send_message(
                 "An Unexpected Error has occurred: Image Not Found"
             )
+            return
+        await inter.response.defer(ephemeral=not self.guild.settings.visible_prompts)
+        metrics.observe(
+            "interaction_ack",
+            (disnake.utils.utcnow() - inter.created_at).total_seconds(),
+        )
         await self.guild.load_modal_values(
             req=self.request,
             prompt=inter.text_values.get("prompt"),
@@ -62,20 +69,15 @@ class Img2ImgModal(disnake.ui.Modal):
             sample_steps=inter.text_values.get("steps"),
             denoising_strength=inter.text_values.get("denoising_strength"),
         )
-        await self.requestor.log_request(
-            request_id=self.request.request_id, prompt=self.request.prompt
-        )
-        await RequestQueue.add(
-            req=self.request, inter=inter, guild=self.guild, requestor=self.requestor
-        )
+        await self.requestor.log_request()
+        await RequestQueue.add(req=self.request, guild=self.guild, inter=inter)
         embed = await self.request.get_prompt_embed(
             queue_pos=await RequestQueue.resolve_queue_pos(
                 req_id=self.request.request_id
-            )
-        )
-        await inter.response.send_message(
-            embed=embed, ephemeral=not self.guild.settings.visible_prompts
+            ),
+            eta=await RequestQueue.resolve_eta(req_id=self.request.request_id),
         )
+        await inter.edit_original_response(embed=embed)
 
 
 class NegativePromptAppendModal(disnake.ui.Modal):
@@ -99,7 +101,7 @@ class NegativePromptAppendModal(disnake.ui.Modal):
 
     async def callback(self, inter: disnake.ModalInteraction):
         self.guild.settings.neg_prompt.extend(inter.text_values["value"].split(","))
-        await self.guild.save_changes()
+        await self.guild.save_settings()
         await inter.response.send_message(
             f"{inter.author.mention} has updated this server's default negative prompt to ```{self.guild.settings.neg_prompt}```"
         )
@@ -127,7 +129,7 @@ class NegativePromptOverwriteModal(disnake.ui.Modal):
 
     async def callback(self, inter: disnake.ModalInteraction):
         self.guild.settings.neg_prompt = inter.text_values["value"].split(",")
-        await self.guild.save_changes()
+        await self.guild.save_settings()
         await inter.response.send_message(
             f"{inter.author.mention} has updated this server's default negative prompt to ```{self.guild.settings.neg_prompt}```"
         )
@@ -0,0 +1,142 @@
+from typing import Dict, Optional, Tuple
+
+import metrics
+import util
+from models.request import Request, RequestStatus
+
+
+class Fit:
+    """
+    A running least squares fit of runtime against cost, kept as sums so it can be
+    updated one observation at a time and combined with other fits.
+    """
+
+    def __init__(self, n=0, sx=0.0, sy=0.0, sxx=0.0, sxy=0.0):
+        self.n = n
+        self.sx = sx
+        self.sy = sy
+        self.sxx = sxx
+        self.sxy = sxy
+
+    def add(self, x: float, y: float):
+        self.n += 1
+        self.sx += x
+        self.sy += y
+        self.sxx += x * x
+        self.sxy += x * y
+
+    def merge(self, other: "Fit"):
+        self.n += other.n
+        self.sx += other.sx
+        self.sy += other.sy
+        self.sxx += other.sxx
+        self.sxy += other.sxy
+
+    def predict(self, x: float) -> Optional[float]:
+        if self.n == 0 or self.sx <= 0:
+            return None
+        spread = self.n * self.sxx - self.sx * self.sx
+        if self.n >= util.predictor_min_samples and spread > 1e-9:
+            slope = (self.n * self.sxy - self.sx * self.sy) / spread
+            intercept = (self.sy - slope * self.sx) / self.n
+            if slope > 0:
+                return max(intercept + slope * x, 0.0)
+        # Too little to go on for a line, assume runtime is proportional to cost
+        return self.sy / self.sx * x
+
+
+class RuntimePredictor:
+    """
+    Predicts how long a request will take to generate from its cost (steps times
+    pixels, see QueueEntry), fitted per backend and request type from finished
+    requests and updated as more finish.
+    """
+
+    fits: Dict[Tuple[Optional[str], str], Fit] = {}
+    populated: bool = False
+
+    @classmethod
+    async def populate(cls):
+        cls.populated = True
+        cls.fits = {}
+        # Batched and cached requests don't say anything about a single generation
+        pipeline = [
+            {
+                "$match": {
+                    "status": RequestStatus.finished.value,
+                    "cached": {"$ne": True},
+                    # Requests from before batching have no batch_size at all
+                    "batch_size": {"$not": {"$gt": 1}},
+                    "runtime": {"$gt": 0},
+                }
+            },
+            {"$sort": {"date": -1}},
+            {"$limit": util.predictor_history},
+            {
+                "$project": {
+                    "backend": 1,
+                    "req_type": 1,
+                    "runtime": 1,
+                    # Requests from before costs were recorded were all 512x512
+                    "cost": {
+                        "$ifNull": [
+                            "$cost",
+                            {"$divide": [{"$ifNull": ["$sample_steps", 20]}, 20]},
+                        ]
+                    },
+                }
+            },
+            {
+                "$group": {
+                    "_id": {"backend": "$backend", "req_type": "$req_type"},
+                    "n": {"$sum": 1},
+                    "sx": {"$sum": "$cost"},
+                    "sy": {"$sum": "$runtime"},
+                    "sxx": {"$sum": {"$multiply": ["$cost", "$cost"]}},
+                    "sxy": {"$sum": {"$multiply": ["$cost", "$runtime"]}},
+                }
+            },
+        ]
+        async for group in Request.get_motor_collection().aggregate(pipeline):
+            cls.fits[(group["_id"].get("backend"), group["_id"]["req_type"])] = Fit(
+                n=group["n"],
+                sx=group["sx"],
+                sy=group["sy"],
+                sxx=group["sxx"],
+                sxy=group["sxy"],
+            )
+
+    @classmethod
+    def observe(cls, backend: str, req_type: str, cost: float, runtime: float):
+        if (predicted := cls.predict(req_type, cost, backend=backend)) is not None:
+            metrics.observe("runtime_prediction_error", abs(predicted - runtime))
+        cls.fits.setdefault((backend, req_type), Fit()).add(cost, runtime)
+
+    @classmethod
+    def predict(
+        cls, req_type: str, cost: float, backend: str = None
+    ) -> Optional[float]:
+        """Expected runtime in seconds, or None if nothing like it has finished."""
+        if backend is not None:
+            fit = cls.fits.get((backend, req_type))
+            if fit is not None and fit.n >= util.predictor_min_samples:
+                return fit.predict(cost)
+        # Not enough from this backend, fall back on every backend, then every type
+        pooled = Fit()
+        for (_, fit_type), fit in cls.fits.items():
+            if fit_type == req_type:
+                pooled.merge(fit)
+        if pooled.n == 0:
+            for fit in cls.fits.values():
+                pooled.merge(fit)
+        return pooled.predict(cost)
+
+
+def format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(round(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}h {minutes}m"
+    if minutes:
+        return f"{minutes}m {seconds}s"
+    return f"{seconds}s"
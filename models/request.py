@@ -1,17 +1,20 @@
 import os
 from datetime import datetime
 from enum import Enum
-from typing import Optional, Dict
+from typing import Optional, Dict, List, Tuple
 
-from beanie import Document
+import pydantic
+from beanie import Document, PydanticObjectId
+from beanie.odm.utils.projection import get_projection
 from bson import ObjectId
 from disnake import Embed, File
+from pymongo import ASCENDING, DESCENDING, TEXT, IndexModel
 
 import util
 from models.embed import EmbedBuilder, Field
+from models.guild_member import GuildMember
 
 # from models.user import UserCache
-from models import user
 from models.user import User
 from util import outputs_dir
 
@@ -29,6 +32,24 @@ class RequestStatus(str, Enum):
     in_progress = "in_progress"
     error = "error"
     finished = "finished"
+    cancelled = "cancelled"
+
+
+class RequestSummary(pydantic.BaseModel):
+    """The parts of a request that lists of them show, projected out of the database."""
+
+    id: PydanticObjectId = pydantic.Field(alias="_id")
+    requestor_id: str
+    date: datetime
+    prompt: str
+    original_prompt: Optional[str]
+    likes: int = 0
+    dislikes: int = 0
+    output_message_url: Optional[str]
+
+    @property
+    def score(self):
+        return self.likes - self.dislikes
 
 
 class Request(Document):
@@ -37,6 +58,26 @@ class Request(Document):
         state_management_replace_objects = True
         is_root = True
         name = "request"
+        indexes = [
+            # Restoring the queue at startup and reaping stale requests
+            IndexModel([("status", ASCENDING), ("date", ASCENDING)]),
+            # A user's or server's requests, newest first. Ties on date are broken
+            # by _id so history can be paged through by (date, _id)
+            IndexModel(
+                [("requestor_id", ASCENDING), ("date", DESCENDING), ("_id", DESCENDING)]
+            ),
+            IndexModel(
+                [
+                    ("source_guild_id", ASCENDING),
+                    ("date", DESCENDING),
+                    ("_id", DESCENDING),
+                ]
+            ),
+            # A server's most liked images of all time
+            IndexModel([("source_guild_id", ASCENDING), ("likes", DESCENDING)]),
+            # Prompt search, which is always within one server
+            IndexModel([("source_guild_id", ASCENDING), ("original_prompt", TEXT)]),
+        ]
 
     requestor_id: str
     source_guild_id: str
@@ -50,10 +91,23 @@ class Request(Document):
     sample_steps: int = None
     original_cfg_scale: Optional[float]
     original_sample_steps: Optional[int]
+    seed: Optional[int]
     status: RequestStatus = RequestStatus.building
     runtime: Optional[float]
+    backend: Optional[str]
+    # How many images were generated alongside this one in the same call
+    batch_size: int = 1
+    # Whether the image was reused from an identical earlier request
+    cached: bool = False
+    # When the worker that took this request is presumed dead
+    lease_expires: Optional[datetime]
+    attempts: int = 0
+    # Steps times pixels, relative to a 20 step 512x512 image
+    cost: Optional[float]
     output_filename: Optional[str]
-    output_url: Optional[str]
+    # Link to the message the image was posted in, which unlike the attachment's
+    # own URL doesn't expire
+    output_message_url: Optional[str]
     likes: int = 0
     dislikes: int = 0
     score_dict: Optional[Dict[str, int]]
@@ -76,39 +130,195 @@ class Request(Document):
 
     @classmethod
     async def get_by_id(cls, mongo_id: str):
-        return await cls.find_one(Request.id == ObjectId(mongo_id))
-
-    def like(self, source: "user.User"):
-        if self.score_dict is None:
-            self.score_dict = {}
-        match self.score_dict.get(source.discord_id, 0):
-            case 1:
-                return
-            case 0:
-                self.likes += 1
-                self.score_dict[source.discord_id] = 1
-            case -1:
-                self.dislikes -= 1
-                self.likes += 1
-                self.score_dict[source.discord_id] = 1
-
-    def dislike(self, source: "user.User"):
-        if self.score_dict is None:
-            self.score_dict = {}
-        match self.score_dict.get(source.discord_id, 0):
-            case -1:
-                return
-            case 0:
-                self.dislikes += 1
-                self.score_dict[source.discord_id] = -1
-            case 1:
-                self.dislikes += 1
-                self.likes -= 1
-                self.score_dict[source.discord_id] = -11
+        return await cls.find_one(Request.id == ObjectId(mongo_id), with_children=True)
+
+    @classmethod
+    async def vote(cls, mongo_id: str, voter_id: str, value: int) -> bool:
+        """
+        Record a like (1) or dislike (-1) from `voter_id` in the database itself, so
+        concurrent votes can't overwrite one another. Returns whether anything changed.
+        """
+        collection = cls.get_motor_collection()
+        _id = ObjectId(mongo_id)
+        path = f"score_dict.{voter_id}"
+        field, other = ("likes", "dislikes") if value > 0 else ("dislikes", "likes")
+        # Just what's needed to credit the vote to whoever made the image
+        owner = {"requestor_id": 1, "source_guild_id": 1}
+        while True:
+            if switched := await collection.find_one_and_update(
+                {"_id": _id, path: {"$lt": 0} if value > 0 else {"$gt": 0}},
+                {"$set": {path: value}, "$inc": {field: 1, other: -1}},
+                projection=owner,
+            ):
+                cls.credit_vote(doc=switched, delta=2 * value)
+                return True
+            if added := await collection.find_one_and_update(
+                {
+                    "_id": _id,
+                    path: {"$exists": False},
+                    "score_dict": {"$type": "object"},
+                },
+                {"$set": {path: value}, "$inc": {field: 1}},
+                projection=owner,
+            ):
+                cls.credit_vote(doc=added, delta=value)
+                return True
+            doc = await collection.find_one({"_id": _id}, {"score_dict": 1})
+            if doc is None:
+                return False
+            if doc.get("score_dict") is None:
+                # Nothing can be set inside a null, give it an empty dict and go again
+                await collection.update_one(
+                    {"_id": _id, "score_dict": None}, {"$set": {"score_dict": {}}}
+                )
+                continue
+            previous = doc["score_dict"].get(voter_id)
+            if previous is not None and (previous > 0) == (value > 0):
+                return False
+            # Another vote from the same user got in between, try again
+
+    @classmethod
+    async def page(
+        cls,
+        guild_id: str,
+        requestor_id: str = None,
+        after: RequestSummary = None,
+        before: RequestSummary = None,
+        limit: int = 5,
+    ) -> List[RequestSummary]:
+        """
+        Finished requests in a server, newest first, either the `limit` right after
+        `after` or the `limit` right before `before`. Seeks to the cursor through
+        the (date, _id) index, so any page is as quick to get as the first.
+        """
+        query = {
+            "source_guild_id": guild_id,
+            "status": RequestStatus.finished.value,
+        }
+        if requestor_id is not None:
+            query["requestor_id"] = requestor_id
+        direction = DESCENDING
+        if after is not None:
+            query["date"] = {"$lte": after.date}
+            query["$or"] = [{"date": {"$lt": after.date}}, {"_id": {"$lt": after.id}}]
+        elif before is not None:
+            direction = ASCENDING
+            query["date"] = {"$gte": before.date}
+            query["$or"] = [{"date": {"$gt": before.date}}, {"_id": {"$gt": before.id}}]
+        page = (
+            await cls.find(query, with_children=True)
+            .sort([("date", direction), ("_id", direction)])
+            .limit(limit)
+            .project(RequestSummary)
+            .to_list()
+        )
+        return page if direction == DESCENDING else page[::-1]
+
+    @classmethod
+    async def search(
+        cls,
+        guild_id: str,
+        text: str,
+        requestor_id: str = None,
+        since: datetime = None,
+        limit: int = 10,
+    ) -> List[RequestSummary]:
+        """
+        Finished requests in a server whose prompts match `text`, best first. How
+        well they match counts most, and a well liked image gets a boost over
+        others that match about as well.
+        """
+        match = {
+            "source_guild_id": guild_id,
+            "$text": {"$search": text},
+            "status": RequestStatus.finished.value,
+        }
+        if requestor_id is not None:
+            match["requestor_id"] = requestor_id
+        if since is not None:
+            match["date"] = {"$gte": since}
+        score = {"$subtract": ["$likes", "$dislikes"]}
+        pipeline = [
+            {"$match": match},
+            {
+                "$addFields": {
+                    "rank": {
+                        "$multiply": [
+                            {"$meta": "textScore"},
+                            {"$add": [1, {"$ln": {"$add": [1, {"$max": [score, 0]}]}}]},
+                        ]
+                    }
+                }
+            },
+            {"$sort": {"rank": -1, "date": -1}},
+            {"$limit": limit},
+            {"$project": get_projection(RequestSummary)},
+        ]
+        return [
+            RequestSummary.parse_obj(doc)
+            async for doc in cls.get_motor_collection().aggregate(pipeline)
+        ]
+
+    @classmethod
+    async def top_images(
+        cls, guild_id: str, since: datetime = None, limit: int = 10
+    ) -> List[RequestSummary]:
+        query = [
+            Request.source_guild_id == guild_id,
+            Request.status == RequestStatus.finished,
+        ]
+        if since is not None:
+            query.append(Request.date >= since)
+        return (
+            await cls.find(*query, with_children=True)
+            .sort(-Request.likes)
+            .limit(limit)
+            .project(RequestSummary)
+            .to_list()
+        )
+
+    @classmethod
+    async def top_requestors(
+        cls, guild_id: str, by: str, since: datetime, limit: int = 10
+    ) -> List[Tuple[str, float]]:
+        """
+        Requestors ranked by `by`, as in GuildMember, but counting only requests
+        made since `since`. Summed from the requests themselves, which the
+        (source_guild_id, date) index narrows to just that window.
+        """
+        totals = {
+            "requests": {"$sum": 1},
+            "score": {"$sum": {"$subtract": ["$likes", "$dislikes"]}},
+            "gpu_seconds": {
+                "$sum": {
+                    "$divide": [
+                        {"$ifNull": ["$runtime", 0]},
+                        {"$ifNull": ["$batch_size", 1]},
+                    ]
+                }
+            },
+        }
+        pipeline = [
+            {"$match": {"source_guild_id": guild_id, "date": {"$gte": since}}},
+            {"$group": {"_id": "$requestor_id", "total": totals[by]}},
+            {"$sort": {"total": -1}},
+            {"$limit": limit},
+        ]
+        return [
+            (group["_id"], group["total"])
+            async for group in cls.get_motor_collection().aggregate(pipeline)
+        ]
+
+    @staticmethod
+    def credit_vote(doc: dict, delta: int):
+        GuildMember.log(
+            guild_id=doc["source_guild_id"], user_id=doc["requestor_id"], score=delta
+        )
 
     async def get_prompt_embed(
         self,
         queue_pos: str,
+        eta: str = None,
     ) -> Embed:
         description = ""
         if util.paused:
@@ -132,6 +342,10 @@ class Request(Document):
                     name="Queue Position",
                     value=queue_pos,
                 ),
+                Field(
+                    name="Estimated Wait",
+                    value=eta or "Unknown",
+                ),
                 Field(
                     name="Sample Steps",
                     value=self.sample_steps,
@@ -144,7 +358,17 @@ class Request(Document):
         )
         return await builder.build()
 
-    async def get_output_embed(self) -> Embed:
+    def get_output_image(self, attached: bool) -> Optional[File]:
+        # Re-renders point at the file already attached to the message, which edits
+        # keep, rather than uploading it again
+        if not attached:
+            return File(os.path.join(outputs_dir, self.output_filename))
+
+    def get_output_image_url(self, attached: bool) -> Optional[str]:
+        if attached:
+            return f"attachment://{self.output_filename}"
+
+    async def get_output_embed(self, attached: bool = False) -> Embed:
         builder = EmbedBuilder(
             title=self.original_prompt[:256].title(),
             description=f"Score: {self.score} (+{self.likes}, -{self.dislikes})",
@@ -156,25 +380,27 @@ class Request(Document):
                 Field(name="Generated in", value=str(self.runtime) + " seconds"),
             ],
             timestamp=self.date,
-            image=File(os.path.join(outputs_dir, self.output_filename)),
+            image=self.get_output_image(attached),
+            image_url=self.get_output_image_url(attached),
         )
         return await builder.build()
 
 
 class Txt2ImgRequest(Request):
     def __init__(self, **kwargs):
-        super().__init__(req_type=RequestType.txt2img, **kwargs)
+        super().__init__(**{"req_type": RequestType.txt2img, **kwargs})
 
 
 class ArtifyRequest(Request):
     original_author_id: int
 
     def __init__(self, **kwargs):
-        super().__init__(req_type=RequestType.artify, **kwargs)
+        super().__init__(**{"req_type": RequestType.artify, **kwargs})
 
     async def get_prompt_embed(
         self,
         queue_pos: str,
+        eta: str = None,
     ) -> Embed:
         description = ""
         if util.paused:
@@ -198,6 +424,10 @@ class ArtifyRequest(Request):
                     name="Queue Position",
                     value=queue_pos,
                 ),
+                Field(
+                    name="Estimated Wait",
+                    value=eta or "Unknown",
+                ),
                 Field(name="Sample Steps", value=self.sample_steps),
                 Field(name="CFG Scale", value=self.cfg_scale),
             ],
@@ -205,7 +435,7 @@ class ArtifyRequest(Request):
         )
         return await builder.build()
 
-    async def get_output_embed(self):
+    async def get_output_embed(self, attached: bool = False):
         builder = EmbedBuilder(
             title=self.original_prompt[:256].title(),
             description=f"Score: {self.score} (+{self.likes}, -{self.dislikes})",
@@ -220,7 +450,8 @@ class ArtifyRequest(Request):
                 Field(name="Generated in", value=str(self.runtime) + " seconds"),
             ],
             timestamp=self.date,
-            image=File(os.path.join(outputs_dir, self.output_filename)),
+            image=self.get_output_image(attached),
+            image_url=self.get_output_image_url(attached),
         )
         return await builder.build()
 
@@ -233,7 +464,7 @@ class Img2ImgRequest(Request):
     status: RequestStatus = RequestStatus.awaiting_prompt
 
     def __init__(self, **kwargs):
-        super().__init__(req_type=RequestType.img2img, **kwargs)
+        super().__init__(**{"req_type": RequestType.img2img, **kwargs})
 
     async def set_original_img(self, url: str) -> None:
         self.original_img_url = url
@@ -241,6 +472,7 @@ class Img2ImgRequest(Request):
     async def get_prompt_embed(
         self,
         queue_pos: str,
+        eta: str = None,
     ) -> Embed:
         description = ""
         if util.paused:
@@ -272,6 +504,10 @@ class Img2ImgRequest(Request):
                     name="Queue Position",
                     value=queue_pos,
                 ),
+                Field(
+                    name="Estimated Wait",
+                    value=eta or "Unknown",
+                ),
                 Field(
                     name="Sample Steps",
                     value=self.sample_steps,
@@ -290,7 +526,7 @@ class Img2ImgRequest(Request):
         )
         return await builder.build()
 
-    async def get_output_embed(self):
+    async def get_output_embed(self, attached: bool = False):
         builder = EmbedBuilder(
             title=self.original_prompt[:256].title(),
             description=f"Score: {self.score} (+{self.likes}, -{self.dislikes})",
@@ -307,7 +543,8 @@ class Img2ImgRequest(Request):
                 ),
             ],
             timestamp=self.date,
-            image=File(os.path.join(outputs_dir, self.output_filename)),
+            image=self.get_output_image(attached),
+            image_url=self.get_output_image_url(attached),
             thumbnail_url=self.original_img_url,
         )
         return await builder.build()
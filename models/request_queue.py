@@ -1,70 +1,808 @@
-from typing import Optional, List, Dict
+import asyncio
+import bisect
+import itertools
+import math
+import sys
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from fractions import Fraction
+from typing import Optional, List, Dict, Iterator, Set
 
+from beanie.operators import In, LT, Set as SetFields
+from bson import ObjectId
 from pydantic import BaseModel
 
-from models import user, guild
-from models.request import Request, RequestStatus
+import metrics
+import util
+from models import caches, user, guild
+from models.backend import Backend, BackendPool
+from models.caches import ResultCache, WriteBehind
+from models.predictor import RuntimePredictor, format_duration
+from models.request import Request, RequestStatus, RequestType
 from util import Interaction
 
 
+class QueueEntry:
+    """
+    What the queue holds for a waiting request: its ids and a few values worked out
+    up front. The documents themselves are only loaded once it's dispatched, so a
+    long queue doesn't keep them (or the interaction) in memory.
+    """
+
+    __slots__ = (
+        "request_id",
+        "requestor_id",
+        "guild_id",
+        "channel_id",
+        "req_type",
+        "token",
+        "weight",
+        "cost",
+        "batch_key",
+        "cache_key",
+        "checkpoint",
+        "passed_over",
+        "enqueued_at",
+    )
+
+    def __init__(
+        self, request: "Request", guild: "guild.Guild", token: Optional[str] = None
+    ):
+        settings = guild.settings
+        self.request_id = request.request_id
+        # Shared between every entry from the same user or server
+        self.requestor_id = sys.intern(request.requestor_id)
+        self.guild_id = sys.intern(request.source_guild_id)
+        self.channel_id = int(request.source_channel_id)
+        self.req_type = request.req_type.value
+        # The interaction token, for deleting the prompt message once it's done
+        self.token = token
+        self.weight = settings.queue_weight
+        # Roughly how much work the request is, in 20 step 512x512 images
+        steps = request.sample_steps or settings.steps
+        steps *= settings.sampler_index.evals_per_step
+        self.cost = steps * settings.width * settings.height / (20 * 512 * 512)
+        self.checkpoint = settings.checkpoint
+        # Times a request further back was dispatched first to avoid a model swap
+        self.passed_over = 0
+        self.batch_key = self.cache_key = None
+        if request.req_type != RequestType.img2img:
+            payload = guild.request_to_payload(req=request)
+            # Identifies the image this request produces, for the result cache. Only
+            # a seed the user picked pins the image down, otherwise it's random, and
+            # without a checkpoint of its own it's down to whatever the backend has
+            if request.seed is not None and settings.checkpoint is not None:
+                self.cache_key = ResultCache.key_for(payload)
+            # Requests with the same key can be generated together in one call. The
+            # WebUI numbers the images in a call seed, seed + 1, ..., so unless the
+            # backend takes lists only unseeded requests with one prompt can share
+            varying = None
+            if util.batch_prompt_lists:
+                varying = ("prompt", "seed")
+            elif request.seed is None:
+                varying = ("seed",)
+            if varying is not None:
+                self.batch_key = ResultCache.key_for(
+                    {k: v for k, v in payload.items() if k not in varying}
+                )
+        self.enqueued_at = time.monotonic()
+
+    @property
+    def expected_runtime(self) -> Optional[float]:
+        return RuntimePredictor.predict(req_type=self.req_type, cost=self.cost)
+
+
 class QueuedRequest(BaseModel):
+    """A dispatched request, with the documents needed to generate and post it."""
+
     class Config:
         arbitrary_types_allowed = True
 
+    entry: QueueEntry
     request: "Request"
-    inter: Interaction
     requestor: "user.User"
     original_author: Optional["user.User"]
     guild: "guild.Guild"
 
 
+class IndexedQueue:
+    """
+    A deque of queued requests keyed by request id.
+
+    Pushing or popping at either end, removing any entry and finding the position
+    of an entry are all O(log n). Every entry is given a sequence number that
+    increases from front to back, and a Fenwick tree over those numbers, updated
+    on every push and removal, counts how many live entries come before a given one.
+    """
+
+    def __init__(self):
+        self.entries: OrderedDict[str, QueueEntry] = OrderedDict()
+        self.seqs: Dict[str, int] = {}
+        self.tree: List[int] = []
+        self.head = 0
+        self.tail = 0
+        self.rebuild()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.entries
+
+    def __iter__(self) -> Iterator[QueueEntry]:
+        return iter(self.entries.values())
+
+    def get(self, key: str) -> Optional[QueueEntry]:
+        return self.entries.get(key)
+
+    def rebuild(self):
+        # Renumber the live entries, leaving room on both sides. Only happens once
+        # the numbers run off either end, so the O(n) cost is amortised away.
+        capacity = max(64, 4 * len(self.entries))
+        self.head = self.tail = capacity // 4
+        self.seqs = {}
+        self.tree = [0] * (capacity + 1)
+        for key in self.entries:
+            self.seqs[key] = self.tail
+            self.tree[self.tail + 1] += 1
+            self.tail += 1
+        for i in range(1, capacity + 1):
+            parent = i + (i & -i)
+            if parent <= capacity:
+                self.tree[parent] += self.tree[i]
+
+    def update(self, seq: int, delta: int):
+        i = seq + 1
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+
+    def count_before(self, seq: int) -> int:
+        total, i = 0, seq
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    def append(self, key: str, entry: QueueEntry):
+        if self.tail >= len(self.tree) - 1:
+            self.rebuild()
+        self.entries[key] = entry
+        self.seqs[key] = self.tail
+        self.update(self.tail, 1)
+        self.tail += 1
+
+    def appendleft(self, key: str, entry: QueueEntry):
+        if self.head <= 0:
+            self.rebuild()
+        self.head -= 1
+        self.entries[key] = entry
+        self.entries.move_to_end(key, last=False)
+        self.seqs[key] = self.head
+        self.update(self.head, 1)
+
+    def remove(self, key: str) -> Optional[QueueEntry]:
+        if key not in self.entries:
+            return None
+        self.update(self.seqs.pop(key), -1)
+        return self.entries.pop(key)
+
+    def popleft(self) -> Optional[QueueEntry]:
+        if not self.entries:
+            return None
+        return self.remove(next(iter(self.entries)))
+
+    def position(self, key: str) -> int:
+        """1-based position of `key`, or -1 if it isn't queued."""
+        if key not in self.seqs:
+            return -1
+        return self.count_before(self.seqs[key]) + 1
+
+
+class ShortestFirstQueue:
+    """
+    A queue with the same interface as IndexedQueue that serves the request expected
+    to finish soonest first. Every second spent waiting takes `sjf_aging` seconds
+    off a request's expected runtime, so large requests still get their turn.
+    Requests put back at the front stay ahead of everything else.
+    """
+
+    def __init__(self):
+        # Sort keys in the order entries go out, alongside the entries themselves
+        self.order: List[tuple] = []
+        self.sort_keys: Dict[str, tuple] = {}
+        self.entries: Dict[str, QueueEntry] = {}
+        self.seq = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.entries
+
+    def __iter__(self) -> Iterator[QueueEntry]:
+        return (self.entries[sort_key[-1]] for sort_key in self.order)
+
+    def get(self, key: str) -> Optional[QueueEntry]:
+        return self.entries.get(key)
+
+    @staticmethod
+    def priority(entry: QueueEntry) -> float:
+        # Nothing has finished yet, cost is in roughly the right units
+        expected = entry.expected_runtime
+        if expected is None:
+            expected = entry.cost
+        # Ordering by expected runtime less aging times time waited is the same as
+        # ordering by this, which doesn't change as time passes
+        return expected + util.sjf_aging * entry.enqueued_at
+
+    def insert(self, key: str, entry: QueueEntry, sort_key: tuple):
+        self.sort_keys[key] = sort_key
+        self.entries[key] = entry
+        bisect.insort(self.order, sort_key)
+
+    def append(self, key: str, entry: QueueEntry):
+        self.seq += 1
+        self.insert(key, entry, (1, self.priority(entry), self.seq, key))
+
+    def appendleft(self, key: str, entry: QueueEntry):
+        self.seq += 1
+        self.insert(key, entry, (0, -self.seq, self.seq, key))
+
+    def remove(self, key: str) -> Optional[QueueEntry]:
+        if key not in self.entries:
+            return None
+        del self.order[bisect.bisect_left(self.order, self.sort_keys.pop(key))]
+        return self.entries.pop(key)
+
+    def popleft(self) -> Optional[QueueEntry]:
+        if not self.order:
+            return None
+        return self.remove(self.order[0][-1])
+
+    def position(self, key: str) -> int:
+        """1-based position of `key`, or -1 if it isn't queued."""
+        if key not in self.sort_keys:
+            return -1
+        return bisect.bisect_left(self.order, self.sort_keys[key]) + 1
+
+
+class Flow:
+    """
+    One guild or user competing for the queue. Flows are served in order of their
+    pass, which advances by their stride (the inverse of their weight) each time
+    they're served, so a flow with twice the weight gets served twice as often.
+    """
+
+    def __init__(self, order: int, pass_: Fraction, stride: Fraction = Fraction(1)):
+        self.order = order
+        self.pass_ = pass_
+        self.stride = stride
+
+    @property
+    def key(self):
+        return self.pass_, self.order
+
+    def count_scheduled_before(self, length: int, tag: Fraction, ties: bool) -> int:
+        """
+        How many of this flow's first `length` entries would be served before an
+        entry tagged `tag`, given that this flow wins ties against it or not.
+        """
+        steps = (tag - self.pass_) / self.stride
+        count = math.floor(steps) + 1 if ties else math.ceil(steps)
+        return min(max(count, 0), length)
+
+
+class UserFlow(Flow):
+    def __init__(self, order: int, pass_: Fraction):
+        super().__init__(order=order, pass_=pass_)
+        self.queue = IndexedQueue()
+
+
+class GuildFlow(Flow):
+    def __init__(self, order: int, pass_: Fraction, stride: Fraction):
+        super().__init__(order=order, pass_=pass_, stride=stride)
+        self.users: Dict[str, UserFlow] = {}
+        self.vtime = Fraction(0)
+        self.next_order = 0
+        self.length = 0
+
+    def get_user(self, user_id: str) -> UserFlow:
+        if user_id not in self.users:
+            # Users that just became active start level with the guild's clock, so
+            # time spent idle isn't banked as credit
+            self.users[user_id] = UserFlow(order=self.next_order, pass_=self.vtime)
+            self.next_order += 1
+        return self.users[user_id]
+
+
+class FairQueue:
+    """
+    A weighted fair queue with the same interface as IndexedQueue.
+
+    Guilds are round-robined in proportion to their `queue_weight`, and users are
+    round-robined equally within each guild, so a single busy user or server can't
+    push everyone else's wait out. Each user's own requests stay in FIFO order.
+    """
+
+    def __init__(self):
+        self.guilds: Dict[str, GuildFlow] = {}
+        self.index: Dict[str, tuple] = {}
+        # Passes are kept as exact fractions so ties between flows resolve the
+        # same way when scheduling and when estimating positions
+        self.vtime = Fraction(0)
+        self.next_order = 0
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.index
+
+    def __iter__(self) -> Iterator[QueueEntry]:
+        # Replays the scheduler on copies of the passes, yielding in dispatch order
+        guild_passes = {gid: g.pass_ for gid, g in self.guilds.items()}
+        guild_lengths = {gid: g.length for gid, g in self.guilds.items()}
+        users = {}
+        for gid, g in self.guilds.items():
+            users[gid] = {
+                uid: [u.pass_, u.order, iter(u.queue), len(u.queue)]
+                for uid, u in g.users.items()
+            }
+        while guild_lengths:
+            gid = min(
+                guild_lengths, key=lambda g: (guild_passes[g], self.guilds[g].order)
+            )
+            uid = min(users[gid], key=lambda u: users[gid][u][:2])
+            user = users[gid][uid]
+            guild_passes[gid] += self.guilds[gid].stride
+            user[0] += 1
+            user[3] -= 1
+            guild_lengths[gid] -= 1
+            if user[3] == 0:
+                del users[gid][uid]
+            if guild_lengths[gid] == 0:
+                del guild_lengths[gid]
+            yield next(user[2])
+
+    def get(self, key: str) -> Optional[QueueEntry]:
+        if key not in self.index:
+            return None
+        gid, uid = self.index[key]
+        return self.guilds[gid].users[uid].queue.get(key)
+
+    def get_flows(self, key: str, entry: QueueEntry):
+        gid, uid = entry.guild_id, entry.requestor_id
+        weight = Fraction(max(entry.weight, 0.01))
+        stride = 1 / weight.limit_denominator(100)
+        if gid not in self.guilds:
+            self.guilds[gid] = GuildFlow(
+                order=self.next_order, pass_=self.vtime, stride=stride
+            )
+            self.next_order += 1
+        guild_flow = self.guilds[gid]
+        guild_flow.stride = stride
+        self.index[key] = (gid, uid)
+        return guild_flow, guild_flow.get_user(uid)
+
+    def append(self, key: str, entry: QueueEntry):
+        guild_flow, user_flow = self.get_flows(key=key, entry=entry)
+        user_flow.queue.append(key, entry)
+        guild_flow.length += 1
+
+    def appendleft(self, key: str, entry: QueueEntry):
+        guild_flow, user_flow = self.get_flows(key=key, entry=entry)
+        # Undo the service the request was charged for, so it goes out next
+        if len(user_flow.queue) > 0 or guild_flow.length > 0:
+            user_flow.pass_ -= user_flow.stride
+            guild_flow.pass_ -= guild_flow.stride
+        user_flow.queue.appendleft(key, entry)
+        guild_flow.length += 1
+
+    def discard_empty(self, gid: str, uid: str):
+        guild_flow = self.guilds[gid]
+        if len(guild_flow.users[uid].queue) == 0:
+            del guild_flow.users[uid]
+        if guild_flow.length == 0:
+            del self.guilds[gid]
+
+    def remove(self, key: str) -> Optional[QueueEntry]:
+        if key not in self.index:
+            return None
+        gid, uid = self.index.pop(key)
+        guild_flow = self.guilds[gid]
+        entry = guild_flow.users[uid].queue.remove(key)
+        guild_flow.length -= 1
+        self.discard_empty(gid=gid, uid=uid)
+        return entry
+
+    def popleft(self) -> Optional[QueueEntry]:
+        if not self.guilds:
+            return None
+        guild_flow = min(self.guilds.values(), key=lambda g: g.key)
+        user_flow = min(guild_flow.users.values(), key=lambda u: u.key)
+        self.vtime = guild_flow.pass_
+        guild_flow.pass_ += guild_flow.stride
+        guild_flow.vtime = user_flow.pass_
+        user_flow.pass_ += user_flow.stride
+        return self.remove(next(iter(user_flow.queue.entries)))
+
+    def position(self, key: str) -> int:
+        """The request's effective position, if nothing else were to be queued."""
+        if key not in self.index:
+            return -1
+        gid, uid = self.index[key]
+        guild_flow = self.guilds[gid]
+        user_flow = guild_flow.users[uid]
+        # Where the request falls among its own guild's requests...
+        user_pos = user_flow.queue.position(key)
+        tag = user_flow.pass_ + (user_pos - 1) * user_flow.stride
+        guild_pos = user_pos + sum(
+            other.count_scheduled_before(
+                length=len(other.queue), tag=tag, ties=other.order < user_flow.order
+            )
+            for other_id, other in guild_flow.users.items()
+            if other_id != uid
+        )
+        # ...and where that slot falls among every guild's
+        tag = guild_flow.pass_ + (guild_pos - 1) * guild_flow.stride
+        return guild_pos + sum(
+            other.count_scheduled_before(
+                length=other.length, tag=tag, ties=other.order < guild_flow.order
+            )
+            for other_id, other in self.guilds.items()
+            if other_id != gid
+        )
+
+
 class RequestQueue:
-    queue: List[str] = None
-    id_lkp: Dict[str, QueuedRequest]
+    queue: IndexedQueue | FairQueue | ShortestFirstQueue = None
+    # Request ids each user currently has queued, oldest first
+    by_requestor: Dict[str, Dict[str, None]]
+    # Ids of requests dispatched to a worker in this process and not yet released
+    leased: Set[str]
+    # Requests waiting out a backoff before they go back in the queue
+    retrying: Dict[str, asyncio.Task]
     populated: bool = False
+    # Set whenever there may be something for a worker to pick up
+    wakeup: asyncio.Event = None
 
     @classmethod
     async def populate(cls):
         cls.populated = True
-        cls.queue = []
-        cls.id_lkp = {}
+        match util.queue_mode:
+            case "fair":
+                cls.queue = FairQueue()
+            case "sjf":
+                cls.queue = ShortestFirstQueue()
+            case _:
+                cls.queue = IndexedQueue()
+        cls.by_requestor = {}
+        cls.leased = set()
+        cls.retrying = {}
+        cls.wakeup = asyncio.Event()
+        if not RuntimePredictor.populated:
+            await RuntimePredictor.populate()
+        await cls.restore()
+
+    @classmethod
+    async def restore(cls):
+        """Rebuild the queue from the requests the last run left unfinished."""
+        # Only one bot owns the queue, so anything still in progress at startup was
+        # orphaned by the previous process and can be handed out again.
+        await Request.find(
+            Request.status == RequestStatus.in_progress, with_children=True
+        ).update(
+            SetFields(
+                {Request.status: RequestStatus.queued, Request.lease_expires: None}
+            )
+        )
+        requests = (
+            await Request.find(
+                Request.status == RequestStatus.queued, with_children=True
+            )
+            .sort(+Request.date)
+            .to_list()
+        )
+        # Anything queued since startup goes behind what was already waiting. Both
+        # are appended in order rather than pushed onto the front, since in fair
+        # mode each appendleft hands the request's flow back a turn of service.
+        restored = await cls.hydrate(requests)
+        newer = [cls.queue.remove(entry.request_id) for entry in list(cls.queue)]
+        newer_ids = {entry.request_id for entry in newer}
+        for qr in restored:
+            if qr.entry.request_id in newer_ids:
+                continue
+            cls.queue.append(qr.entry.request_id, qr.entry)
+            cls.track(qr.entry)
+        for entry in newer:
+            cls.queue.append(entry.request_id, entry)
+        cls.notify()
+
+    @classmethod
+    async def hydrate(
+        cls, requests: List["Request"], entries: Dict[str, QueueEntry] = None
+    ) -> List[QueuedRequest]:
+        """
+        Load the guilds and users for a batch of requests, from the caches where
+        they're there and otherwise with one query each.
+        """
+        if not requests:
+            return []
+        entries = entries or {}
+        guild_ids = {req.source_guild_id for req in requests}
+        user_ids = {req.requestor_id for req in requests} | {
+            str(req.original_author_id)
+            for req in requests
+            if getattr(req, "original_author_id", None) is not None
+        }
+        guilds = {gid: g for gid in guild_ids if (g := caches.guilds.peek(gid))}
+        users = {uid: u for uid in user_ids if (u := caches.users.peek(uid))}
+        if missing := guild_ids - guilds.keys():
+            for g in await guild.Guild.find(
+                In(guild.Guild.discord_id, list(missing))
+            ).to_list():
+                guilds[g.discord_id] = g
+        if missing := user_ids - users.keys():
+            for u in await user.User.find(
+                In(user.User.discord_id, list(missing))
+            ).to_list():
+                users[u.discord_id] = u
+        hydrated = []
+        for req in requests:
+            source_guild = guilds.get(req.source_guild_id)
+            requestor = users.get(req.requestor_id)
+            if source_guild is None or requestor is None:
+                req.status = RequestStatus.error
+                WriteBehind.stage_changes(req)
+                continue
+            hydrated.append(
+                QueuedRequest(
+                    entry=entries.get(req.request_id)
+                    or QueueEntry(request=req, guild=source_guild),
+                    request=req,
+                    guild=source_guild,
+                    requestor=requestor,
+                    original_author=users.get(
+                        str(getattr(req, "original_author_id", None))
+                    ),
+                )
+            )
+        return hydrated
+
+    @classmethod
+    async def load(cls, entries: List[QueueEntry]) -> List[QueuedRequest]:
+        """
+        Load everything a worker needs for the entries it dequeued. Entries whose
+        request can't be loaded are dropped.
+        """
+        # Requests queued moments ago may not have been written yet
+        await WriteBehind.flush()
+        requests = {
+            req.request_id: req
+            for req in await Request.find(
+                In(Request.id, [ObjectId(entry.request_id) for entry in entries]),
+                with_children=True,
+            ).to_list()
+        }
+        loaded = await cls.hydrate(
+            [requests[e.request_id] for e in entries if e.request_id in requests],
+            entries={entry.request_id: entry for entry in entries},
+        )
+        loaded_ids = {qr.entry.request_id for qr in loaded}
+        for entry in entries:
+            if entry.request_id not in loaded_ids:
+                cls.release(entry.request_id)
+        return loaded
+
+    @classmethod
+    async def reap(cls):
+        """
+        Requeue in-progress requests whose lease ran out and abandon Img2Img requests
+        that never got a prompt.
+        """
+        if not cls.populated:
+            await cls.populate()
+        # Leases and statuses may still be waiting to be written
+        await WriteBehind.flush()
+        now = datetime.utcnow()
+        stale = [
+            req
+            for req in await Request.find(
+                Request.status == RequestStatus.in_progress,
+                LT(Request.lease_expires, now),
+                with_children=True,
+            ).to_list()
+            if req.request_id not in cls.leased
+            and req.request_id not in cls.queue
+            and req.request_id not in cls.retrying
+        ]
+        for qr in await cls.hydrate(stale):
+            if qr.request.attempts >= util.max_attempts:
+                qr.request.status = RequestStatus.error
+                WriteBehind.stage_changes(qr.request)
+            else:
+                await cls.requeue(qr)
+        await Request.find(
+            Request.status == RequestStatus.awaiting_prompt,
+            LT(Request.date, now - timedelta(seconds=util.awaiting_prompt_timeout)),
+            with_children=True,
+        ).update(SetFields({Request.status: RequestStatus.error}))
+
+    @classmethod
+    def notify(cls):
+        if cls.wakeup is not None:
+            cls.wakeup.set()
+
+    @classmethod
+    async def wait(cls):
+        """Block until there is a request to dispatch and the bot isn't paused."""
+        if not cls.populated:
+            await cls.populate()
+        while util.paused or len(cls.queue) == 0:
+            cls.wakeup.clear()
+            await cls.wakeup.wait()
+
+    @classmethod
+    def track(cls, entry: QueueEntry):
+        cls.by_requestor.setdefault(entry.requestor_id, {})[entry.request_id] = None
+
+    @classmethod
+    def untrack(cls, entry: QueueEntry):
+        requests = cls.by_requestor.get(entry.requestor_id, {})
+        requests.pop(entry.request_id, None)
+        if not requests:
+            cls.by_requestor.pop(entry.requestor_id, None)
 
     @classmethod
     async def add(
         cls,
         req: "Request",
-        inter: Interaction,
         guild: "guild.Guild",
-        requestor: "user.User",
-        original_author: "user.User" = None,
-    ):
+        inter: Optional[Interaction] = None,
+    ) -> Optional[str]:
+        """
+        Queue `req`, unless an identical request has already finished. In that case
+        it isn't queued and the cached image is returned for the caller to answer
+        with straight away, paused or not.
+        """
         if not cls.populated:
             await cls.populate()
-        req.status = RequestStatus.queued
-        await req.save_changes()
-        cls.queue.append(req.request_id)
-        cls.id_lkp[req.request_id] = QueuedRequest(
-            request=req,
-            inter=inter,
-            guild=guild,
-            requestor=requestor,
-            original_author=original_author,
+        entry = QueueEntry(
+            request=req, guild=guild, token=inter.token if inter is not None else None
         )
+        # A miss is counted when the request is looked up again on dispatch
+        if entry.cache_key and (
+            path := ResultCache.lookup(entry.cache_key, count_misses=False)
+        ):
+            return path
+        req.status = RequestStatus.queued
+        WriteBehind.stage_changes(req)
+        cls.queue.append(entry.request_id, entry)
+        cls.track(entry)
+        cls.notify()
+
+    @classmethod
+    def peek_checkpoint(cls) -> Optional[str]:
+        """The checkpoint the request at the front of the queue needs, if any."""
+        if cls.populated and (head := next(iter(cls.queue), None)):
+            return head.checkpoint
+
+    @classmethod
+    def take_for(cls, backend: Optional[Backend]) -> QueueEntry | None:
+        """
+        Pop the next entry for `backend`. If the front of the queue needs a different
+        checkpoint than the one it has loaded, a request that can use the loaded one
+        is taken from up to `checkpoint_window` places back instead, but the front is
+        never passed over more than `checkpoint_window` times.
+        """
+        head = next(iter(cls.queue), None)
+        loaded = backend.checkpoint if backend is not None else None
+        if (
+            head is None
+            or loaded is None
+            or head.checkpoint in (None, loaded)
+            or head.passed_over >= util.checkpoint_window
+        ):
+            return cls.queue.popleft()
+        for entry in itertools.islice(cls.queue, 1, util.checkpoint_window + 1):
+            if entry.checkpoint in (None, loaded):
+                head.passed_over += 1
+                metrics.increment("checkpoint_swaps_avoided")
+                return cls.queue.remove(entry.request_id)
+        return cls.queue.popleft()
 
     @classmethod
-    async def dequeue(cls) -> QueuedRequest | None:
+    async def dequeue(cls, backend: Backend = None) -> QueueEntry | None:
         if not cls.populated:
             await cls.populate()
-        if len(cls.queue) > 0:
-            qr = cls.id_lkp.pop(cls.queue.pop(0))
-            return qr
+        if entry := cls.take_for(backend):
+            cls.untrack(entry)
+            cls.leased.add(entry.request_id)
+            metrics.observe("queue_wait", time.monotonic() - entry.enqueued_at)
+            return entry
+
+    @classmethod
+    async def fill_batch(cls, head: QueueEntry) -> List[QueueEntry]:
+        """
+        Take queued requests that can be generated alongside `head`, looking a short
+        way ahead in the queue and waiting up to `batch_wait` for more to arrive.
+        """
+        batch = [head]
+        if (key := head.batch_key) is None or util.max_batch_size <= 1:
+            return batch
+        deadline = time.monotonic() + util.batch_wait
+        while True:
+            lookahead = itertools.islice(cls.queue, util.batch_lookahead)
+            matches = [
+                entry.request_id for entry in lookahead if entry.batch_key == key
+            ][: util.max_batch_size - len(batch)]
+            for req_id in matches:
+                entry = cls.queue.remove(req_id)
+                cls.untrack(entry)
+                cls.leased.add(req_id)
+                metrics.observe("queue_wait", time.monotonic() - entry.enqueued_at)
+                batch.append(entry)
+            remaining = deadline - time.monotonic()
+            if len(batch) >= util.max_batch_size or remaining <= 0:
+                break
+            cls.wakeup.clear()
+            try:
+                await asyncio.wait_for(cls.wakeup.wait(), timeout=remaining)
+            except asyncio.TimeoutError:
+                pass
+        metrics.increment("batches")
+        metrics.increment("batched_requests", len(batch))
+        return batch
+
+    @classmethod
+    def release(cls, req_id: str):
+        """Called by a worker once it's done with a request it dequeued."""
+        cls.leased.discard(req_id)
 
     @classmethod
     async def requeue(cls, qr: QueuedRequest):
-        new = [qr.request.request_id]
-        new.extend(cls.queue)
-        cls.queue = new
-        cls.id_lkp[qr.request.request_id] = qr
+        if not cls.populated:
+            await cls.populate()
+        qr.request.status = RequestStatus.queued
+        WriteBehind.stage_changes(qr.request)
+        qr.entry.enqueued_at = time.monotonic()
+        cls.queue.appendleft(qr.entry.request_id, qr.entry)
+        cls.track(qr.entry)
+        cls.notify()
+
+    @classmethod
+    def retry(cls, qr: QueuedRequest, delay: float):
+        """Put a failed request back at the front of the queue after `delay` seconds."""
+        metrics.increment("retries")
+        cls.retrying[qr.entry.request_id] = asyncio.create_task(
+            cls.requeue_after(qr=qr, delay=delay)
+        )
+
+    @classmethod
+    async def requeue_after(cls, qr: QueuedRequest, delay: float):
+        try:
+            await asyncio.sleep(delay)
+            await cls.requeue(qr)
+        finally:
+            cls.retrying.pop(qr.entry.request_id, None)
+
+    @classmethod
+    async def remove(cls, req_id: str) -> QueueEntry | None:
+        if not cls.populated:
+            await cls.populate()
+        if entry := cls.queue.remove(req_id):
+            cls.untrack(entry)
+            return entry
+
+    @classmethod
+    async def get_latest(cls, requestor_id: str) -> QueueEntry | None:
+        """The most recently queued request still waiting for the given user."""
+        if not cls.populated:
+            await cls.populate()
+        if requests := cls.by_requestor.get(requestor_id):
+            return cls.queue.get(next(reversed(requests)))
 
     @classmethod
     async def get_length(cls):
@@ -76,9 +814,37 @@ class RequestQueue:
     async def get_pos(cls, req_id: str):
         if not cls.populated:
             await cls.populate()
-        if req_id not in cls.queue:
-            return -1
-        return cls.queue.index(req_id) + 1
+        return cls.queue.position(req_id)
+
+    @classmethod
+    async def estimate_wait(cls, req_id: str) -> Optional[float]:
+        """
+        Seconds until the request should be done, going by the expected runtimes of
+        everything ahead of it. None if there isn't enough history to tell, or the
+        request is more than `eta_horizon` places back.
+        """
+        if not cls.populated:
+            await cls.populate()
+        # Positions are cheap to find, but adding up what's ahead means walking the
+        # queue, so past the horizon the wait is left unknown
+        if not 0 < cls.queue.position(req_id) <= util.eta_horizon:
+            return None
+        capacity = sum(b.limit for b in BackendPool.get_backends() if b.healthy) or 1
+        ahead = 0.0
+        for entry in itertools.islice(cls.queue, util.eta_horizon):
+            if (expected := entry.expected_runtime) is None:
+                return None
+            if entry.request_id == req_id:
+                return ahead / capacity + expected
+            ahead += expected
+
+    @classmethod
+    async def resolve_eta(cls, req_id: str) -> Optional[str]:
+        if util.paused:
+            return None
+        if (wait := await cls.estimate_wait(req_id=req_id)) is None:
+            return None
+        return f"~{format_duration(wait)}"
 
     @classmethod
     async def resolve_queue_pos(cls, req_id: str):
@@ -1,7 +1,11 @@
-from typing import Dict, List, Optional
+from typing import List, Optional
 
 import disnake
 from beanie import Document
+from pymongo import ASCENDING, IndexModel
+
+from models import caches
+from models.caches import WriteBehind
 
 
 class User(Document):
@@ -9,13 +13,16 @@ class User(Document):
         use_state_management = True
         state_management_replace_objects = True
         name = "user"
+        indexes = [
+            IndexModel([("discord_id", ASCENDING)], unique=True),
+            IndexModel([("username", ASCENDING)]),
+        ]
 
     discord_id: str
     username: str
     req_count: int = 0
     favorites: List[str] = None
     guilds: List[str] = None
-    requests: Dict[str, str] = None
 
     @property
     def int_discord_id(self):
@@ -33,14 +40,17 @@ class User(Document):
     async def find_or_create(
         cls, discord_id: int = None, disnake_user: disnake.User = None
     ) -> "User":
-        qry_id = disnake_user.id if disnake_user is not None else discord_id
-        if extant := await cls.find_one(User.discord_id == str(qry_id)):
-            return extant
-        else:
-            return cls(
+        qry_id = str(disnake_user.id if disnake_user is not None else discord_id)
+
+        async def load() -> "User":
+            if extant := await cls.find_one(User.discord_id == qry_id):
+                return extant
+            return await cls(
                 discord_id=qry_id,
                 username=disnake_user.name if disnake_user is not None else None,
-            )
+            ).insert()
+
+        return await caches.users.get(qry_id, loader=load)
 
     @classmethod
     async def find_by_username(cls, username: str) -> Optional["User"]:
@@ -54,12 +64,7 @@ class User(Document):
         if guild_id not in self.guilds:
             self.guilds.append(str(guild_id))
 
-    async def log_request(
-        self,
-        request_id: str,
-        prompt: str,
-    ):
-        if self.requests is None:
-            self.requests = {}
-        self.requests[request_id] = prompt
-        await self.save_changes()
+    async def log_request(self):
+        # Past requests are looked up by requestor_id, only the count is kept here
+        self.req_count += 1
+        WriteBehind.stage(self, inc={"req_count": 1})
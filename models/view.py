@@ -1,38 +1,150 @@
+import asyncio
+from typing import List, Optional
+
 import disnake
 from disnake.ui import View
 
 from emotes import thumbs_up, thumbs_down
-from models.request import Request
+from models.embed import EmbedBuilder, Field
+from models.request import Request, RequestSummary
 from models.user import User
+from util import history_page_size, vote_render_delay
 
 
 class ScoreView(View):
     request_id: str
+    # A re-render of the message waiting on the vote window, if any
+    render_task: Optional[asyncio.Task]
+    stale: bool
 
     def __init__(self, request_id: str):
         super().__init__(timeout=None)
         self.request_id = request_id
+        self.render_task = None
+        self.stale = False
 
     @disnake.ui.button(emoji=thumbs_up, style=disnake.ButtonStyle.success, row=0)
     async def like(self, button: disnake.ui.Button, inter: disnake.MessageInteraction):
-        request = await Request.get_by_id(mongo_id=self.request_id)
-        requestor = await User.find_or_create(disnake_user=inter.author)
-        request.like(source=requestor)
-        await request.save_changes()
-        await inter.message.edit(embed=await request.get_output_embed())
-        await inter.response.defer(ephemeral=True)
+        await self.vote(inter=inter, value=1)
 
     @disnake.ui.button(emoji=thumbs_down, style=disnake.ButtonStyle.danger, row=0)
     async def dislike(
         self, button: disnake.ui.Button, inter: disnake.MessageInteraction
     ):
-        request = await Request.get_by_id(mongo_id=self.request_id)
-        requestor = await User.find_or_create(disnake_user=inter.author)
-        request.dislike(source=requestor)
-        await request.save_changes()
-        await inter.message.edit(embed=await request.get_output_embed())
+        await self.vote(inter=inter, value=-1)
+
+    async def vote(self, inter: disnake.MessageInteraction, value: int):
         await inter.response.defer(ephemeral=True)
+        requestor = await User.find_or_create(disnake_user=inter.author)
+        if await Request.vote(
+            mongo_id=self.request_id, voter_id=requestor.discord_id, value=value
+        ):
+            self.schedule_render(message=inter.message)
+
+    def schedule_render(self, message: disnake.Message):
+        self.stale = True
+        if self.render_task is None or self.render_task.done():
+            self.render_task = asyncio.create_task(self.render(message=message))
+
+    async def render(self, message: disnake.Message):
+        # Votes that land while this is running mark it stale again, so the last
+        # edit always shows the final score
+        while self.stale:
+            await asyncio.sleep(vote_render_delay)
+            self.stale = False
+            request = await Request.get_by_id(mongo_id=self.request_id)
+            await message.edit(embed=await request.get_output_embed(attached=True))
 
 
 class RecordsView(View):
-    user_id: str
+    """
+    Pages through a server's finished requests, or one user's, newest first. The
+    next page is fetched while the current one is being looked at.
+    """
+
+    guild_id: str
+    user_id: Optional[str]
+    page: List[RequestSummary]
+    number: int
+    has_next: bool
+    prefetch: Optional[asyncio.Task]
+
+    def __init__(self, guild_id: str, user_id: Optional[str] = None):
+        super().__init__(timeout=600)
+        self.guild_id = guild_id
+        self.user_id = user_id
+        self.page = []
+        self.number = 0
+        self.has_next = False
+        self.prefetch = None
+
+    async def fetch(
+        self, after: RequestSummary = None, before: RequestSummary = None
+    ) -> List[RequestSummary]:
+        return await Request.page(
+            guild_id=self.guild_id,
+            requestor_id=self.user_id,
+            after=after,
+            before=before,
+            # One extra going forward to tell whether there's a page after it
+            limit=history_page_size + (before is None),
+        )
+
+    def show(self, page: List[RequestSummary], number: int):
+        self.has_next = len(page) > history_page_size
+        self.page = page[:history_page_size]
+        self.number = number
+        self.previous_page.disabled = number <= 1
+        self.next_page.disabled = not self.has_next
+        if self.prefetch is not None:
+            self.prefetch.cancel()
+        self.prefetch = None
+        if self.has_next:
+            self.prefetch = asyncio.create_task(self.fetch(after=self.page[-1]))
+
+    async def first(self) -> dict:
+        """Load the first page, giving what to send it with."""
+        self.show(await self.fetch(), number=1)
+        return await self.render()
+
+    async def render(self) -> dict:
+        if not self.page:
+            return {"content": "Nothing has been generated here yet.", "embeds": []}
+        embeds = [
+            await EmbedBuilder(
+                title=(summary.original_prompt or summary.prompt)[:256],
+                fields=[
+                    Field(
+                        name="Requestor",
+                        value=User.construct_mention(summary.requestor_id),
+                    ),
+                    Field(
+                        name="Score",
+                        value=f"{summary.score} (+{summary.likes}, -{summary.dislikes})",
+                    ),
+                ],
+                timestamp=summary.date,
+                # Older requests never recorded their message, so go without
+                url=summary.output_message_url,
+            ).build()
+            for summary in self.page
+        ]
+        return {"content": f"Page {self.number}", "embeds": embeds}
+
+    @disnake.ui.button(emoji="◀", style=disnake.ButtonStyle.secondary, row=0)
+    async def previous_page(
+        self, button: disnake.ui.Button, inter: disnake.MessageInteraction
+    ):
+        # Full pages before this one, so there is always a next page from there
+        page = await self.fetch(before=self.page[0])
+        self.show(page + [self.page[0]], number=self.number - 1)
+        await inter.response.edit_message(**await self.render(), view=self)
+
+    @disnake.ui.button(emoji="▶", style=disnake.ButtonStyle.secondary, row=0)
+    async def next_page(
+        self, button: disnake.ui.Button, inter: disnake.MessageInteraction
+    ):
+        page = await self.prefetch if self.prefetch is not None else []
+        self.prefetch = None
+        self.show(page, number=self.number + 1)
+        await inter.response.edit_message(**await self.render(), view=self)
@@ -8,6 +8,85 @@ from dotenv import dotenv_values
 values = dotenv_values()
 token = values.get("DISCORD_TOKEN")
 base_url = values.get("BASE_URL", "http://127.0.0.1:7860")
+# Comma separated list of WebUI instances, each optionally suffixed with "|<limit>"
+backends = [
+    entry.strip()
+    for entry in values.get("BACKENDS", base_url).split(",")
+    if entry.strip()
+]
+default_backend_concurrency = int(values.get("BACKEND_CONCURRENCY", 1))
+health_check_interval = float(values.get("HEALTH_CHECK_INTERVAL", 30))
+# A backend is taken out of rotation after this many timeouts in a row (or any
+# connection error), and probed again after a cooldown that doubles each time
+# it fails again, up to the maximum
+breaker_threshold = int(values.get("BREAKER_THRESHOLD", 3))
+breaker_cooldown = float(values.get("BREAKER_COOLDOWN", 10))
+breaker_max_cooldown = float(values.get("BREAKER_MAX_COOLDOWN", 300))
+# Generation calls time out after this many seconds plus the factor times their
+# expected runtime. Requests with no history to go on are assumed to take
+# unknown_cost_seconds per unit of cost
+request_timeout = float(values.get("REQUEST_TIMEOUT", 60))
+request_timeout_factor = float(values.get("REQUEST_TIMEOUT_FACTOR", 3))
+unknown_cost_seconds = float(values.get("UNKNOWN_COST_SECONDS", 10))
+connect_timeout = float(values.get("CONNECT_TIMEOUT", 10))
+# Failed requests are retried after retry_backoff seconds, doubling each attempt
+retry_backoff = float(values.get("RETRY_BACKOFF", 5))
+# "fifo" serves requests in order, "fair" round-robins across servers and users,
+# "sjf" serves the requests expected to finish soonest first
+queue_mode = values.get("QUEUE_MODE", "fifo")
+# Up to how many compatible txt2img requests are generated in one call, and how
+# long (in seconds) the dispatcher may hold a backend waiting for a batch to fill
+max_batch_size = int(values.get("MAX_BATCH_SIZE", 1))
+batch_wait = float(values.get("BATCH_WAIT", 0.5))
+batch_lookahead = int(values.get("BATCH_LOOKAHEAD", 32))
+# The stock WebUI takes one prompt and one seed per call. Backends that accept a
+# list of each can batch requests with different prompts and seeds as well
+batch_prompt_lists = values.get("BATCH_PROMPT_LISTS", "false").lower() == "true"
+# How much disk the cache of finished images may use, in bytes (0 turns it off)
+result_cache_bytes = int(values.get("RESULT_CACHE_BYTES", 1024**3))
+# How many guild and user documents are kept in memory each, and for how long
+document_cache_size = int(values.get("DOCUMENT_CACHE_SIZE", 10000))
+document_cache_ttl = float(values.get("DOCUMENT_CACHE_TTL", 300))
+write_behind_interval = float(values.get("WRITE_BEHIND_INTERVAL", 2))
+# How long a dispatched request may stay in progress before it's handed out again
+lease_duration = float(values.get("LEASE_DURATION", 600))
+max_attempts = int(values.get("MAX_ATTEMPTS", 3))
+# How long an Img2Img request may wait for its prompt before it's abandoned
+awaiting_prompt_timeout = float(values.get("AWAITING_PROMPT_TIMEOUT", 3600))
+reap_interval = float(values.get("REAP_INTERVAL", 300))
+# Votes on an output re-render its message at most once per this many seconds
+vote_render_delay = float(values.get("VOTE_RENDER_DELAY", 2))
+# Largest image accepted as an Img2Img input, and how much memory is spent keeping
+# recently used inputs around, both in bytes
+max_input_bytes = int(values.get("MAX_INPUT_BYTES", 25 * 1024**2))
+input_cache_bytes = int(values.get("INPUT_CACHE_BYTES", 256 * 1024**2))
+# How many seconds downloading an Img2Img input may take, separately from the
+# timeouts on calls to the WebUI
+download_timeout = float(values.get("DOWNLOAD_TIMEOUT", 30))
+# How many finished requests runtime predictions are fitted from, and how many a
+# backend needs before it gets predictions of its own
+predictor_history = int(values.get("PREDICTOR_HISTORY", 5000))
+predictor_min_samples = int(values.get("PREDICTOR_MIN_SAMPLES", 5))
+# How far back in the queue a request may be and still be given an estimated wait,
+# which means adding up the expected runtimes of everything ahead of it
+eta_horizon = int(values.get("ETA_HORIZON", 200))
+# In "sjf" mode, how many seconds of expected runtime a request is forgiven for
+# every second it has waited, so large requests aren't starved
+sjf_aging = float(values.get("SJF_AGING", 0.1))
+# How long a command waits on its server's settings before acknowledging without
+# them (and keeping the prompt to the requestor, to be safe)
+ack_budget = float(values.get("ACK_BUDGET", 1))
+# How far down the queue a backend may look for a request that uses the checkpoint
+# it has loaded, and how many times any one request may be passed over for that
+checkpoint_window = int(values.get("CHECKPOINT_WINDOW", 8))
+# Database commands slower than this many milliseconds are logged, along with
+# whether they had an index to use
+slow_query_ms = float(values.get("SLOW_QUERY_MS", 100))
+# How many past requests /history shows at a time
+history_page_size = int(values.get("HISTORY_PAGE_SIZE", 5))
+http_pool_limit = int(values.get("HTTP_POOL_LIMIT", 32))
+http_pool_limit_per_host = int(values.get("HTTP_POOL_LIMIT_PER_HOST", 8))
+http_keepalive_timeout = float(values.get("HTTP_KEEPALIVE_TIMEOUT", 75))
 main_dir = os.path.split(os.path.abspath(__file__))[0]
 guild_data_path = os.path.join(main_dir, "data/guilds.json")
 user_data_path = os.path.join(main_dir, "data/users.json")